@@ -0,0 +1,407 @@
+"""
+Benchmarks of the scraping code that run without network access.
+
+The search and download benchmarks drive get_youtube_urls and scrape_audio against FakeYouTube (a local fake
+of the googleapiclient search/videos endpoints), FakeYoutubeDL (a stub of youtube_dl) and a fake ffmpeg,
+with configurable latency, file sizes and failure rates.
+
+Run with:
+python benchmark.py [keywords|search|slices|scrape|all] [--sizes 100 10000 100000]
+"""
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+import main
+from main import KeywordFilter, RunStats
+import tracemalloc
+import threading
+import tempfile
+import argparse
+import random
+import shutil
+import string
+import timeit
+import types
+import zlib
+import subprocess
+import time
+import io
+import os
+
+
+def legacy_keyword_filter(title, description, must_have_in_title_or_description, must_not_have_in_title_or_description):
+    """
+    The filter loop that get_youtube_urls used before KeywordFilter (with the found_wrong_word bug fixed).
+    """
+    lower_case_title = title.lower()
+    lower_case_description = description.lower()
+    if must_have_in_title_or_description:
+        for word in must_have_in_title_or_description:
+            if (word in lower_case_title) or (word in lower_case_description):
+                break
+        else:
+            return False
+    for word in must_not_have_in_title_or_description:
+        if (word in lower_case_title) or (word in lower_case_description):
+            return False
+    return True
+
+
+def random_words(rng, count, length=7):
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(length)) for _ in range(count)]
+
+
+def benchmark_keyword_filter(n_videos=2000, n_keywords=(2, 20, 200, 500, 2000), repeat=5, seed=0):
+    """
+    Compare KeywordFilter with the legacy loop on random snippets, for a growing number of keywords.
+    Prints the time per video of both and checks that they accept the same videos.
+    """
+    rng = random.Random(seed)
+    vocabulary = random_words(rng, 5000)
+    videos = [(' '.join(rng.choices(vocabulary, k=8)), ' '.join(rng.choices(vocabulary, k=60)))
+              for _ in range(n_videos)]
+    print(f'keyword filter, {n_videos} videos')
+    for count in n_keywords:
+        must_have = rng.sample(vocabulary, count)
+        must_not_have = rng.sample(vocabulary, count)
+        keyword_filter = KeywordFilter(must_have, must_not_have, casefold=False)
+        casefold_filter = KeywordFilter(must_have, must_not_have, casefold=True)
+
+        legacy = [legacy_keyword_filter(title, description, must_have, must_not_have) for title, description in videos]
+        compiled = [keyword_filter.matches(title, description) for title, description in videos]
+        assert legacy == compiled, 'KeywordFilter and the legacy loop disagree'
+
+        legacy_seconds = min(timeit.repeat(
+            lambda: [legacy_keyword_filter(title, description, must_have, must_not_have) for title, description in videos],
+            number=1, repeat=repeat))
+        compiled_seconds = min(timeit.repeat(
+            lambda: [keyword_filter.matches(title, description) for title, description in videos],
+            number=1, repeat=repeat))
+        # With casefold=True the filter also unescapes html and casefolds, which the legacy loop didn't do.
+        casefold_seconds = min(timeit.repeat(
+            lambda: [casefold_filter.matches(title, description) for title, description in videos],
+            number=1, repeat=repeat))
+        print(f'{count:>6} keywords: legacy {legacy_seconds / n_videos * 1e6:8.1f} us/video, '
+              f'compiled {compiled_seconds / n_videos * 1e6:8.1f} us/video, '
+              f'speedup x{legacy_seconds / compiled_seconds:.1f}, '
+              f'with casefold {casefold_seconds / n_videos * 1e6:8.1f} us/video')
+
+
+def scrambled_fraction(index, salt=0):
+    """
+    A deterministic pseudo random number in [0, 1) for the index-th result.
+    """
+    return zlib.crc32(f'{salt}-{index}'.encode()) % 1000 / 1000
+
+
+class FakeRequest:
+    def __init__(self, respond, params):
+        self.respond = respond
+        self.params = params
+
+    def execute(self):
+        return self.respond(**self.params)
+
+
+class FakeResource:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def list(self, **params):
+        return FakeRequest(self.respond, params)
+
+
+class FakeYouTube:
+    """
+    A fake of the YouTube Data API client that build() returns, with search().list and videos().list.
+
+    Parameters:
+    - n_results (int): How many results the search has (50 per page).
+    - match_ratio (float, optional): The part of the results whose title has the must have word 'bass'.
+    - reject_ratio (float, optional): The part of the results that the default pre-screen rejects (too long).
+    - latency (float, optional): Seconds every API call takes.
+    - failure_rate (float, optional): The part of the API calls that raise an error.
+    - result_cap (int, optional): Like YouTube, stop paging a query after result_cap results. Every slice
+      (query and publishedAfter) then sees its own part of the n_results. Defaults to None (no cap).
+    """
+
+    def __init__(self, n_results, match_ratio=0.5, reject_ratio=0.1, latency=0.0, failure_rate=0.0,
+                 result_cap=None):
+        self.n_results = n_results
+        self.result_cap = result_cap
+        self.match_ratio = match_ratio
+        self.reject_ratio = reject_ratio
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.calls = {'search': 0, 'videos': 0}
+
+    def search(self):
+        return FakeResource(self.search_page)
+
+    def videos(self):
+        return FakeResource(self.video_details)
+
+    def call(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+            call_index = sum(self.calls.values())
+        time.sleep(self.latency)
+        if scrambled_fraction(call_index, 'api') < self.failure_rate:
+            raise RuntimeError(f'fake {endpoint} API error, HTTP Error 503')
+
+    def search_page(self, pageToken, maxResults, **params):
+        self.call('search')
+        page = 0 if pageToken == 'default' else int(pageToken)
+        start = page * maxResults
+        n_results = self.n_results
+        offset = 0
+        if self.result_cap is not None:
+            n_results = min(n_results, self.result_cap)
+            offset = zlib.crc32(f'{params.get("q")} {params.get("publishedAfter")}'.encode())
+        stop = min(start + maxResults, n_results)
+        items = []
+        for index in ((offset + position) % self.n_results for position in range(start, stop)):
+            instrument = 'bass' if scrambled_fraction(index, 'match') < self.match_ratio else 'guitar'
+            items.append({'id': {'videoId': f'{index:011d}'},
+                          'snippet': {'title': f'{instrument} sample {index}',
+                                      'description': f'a {instrument} loop recorded in a studio',
+                                      'channelTitle': 'fake channel',
+                                      'liveBroadcastContent': 'none'}})
+        res = {'items': items}
+        if stop < n_results:
+            res['nextPageToken'] = str(page + 1)
+        return res
+
+    def video_details(self, id, **params):
+        self.call('videos')
+        items = []
+        for video_id in id.split(','):
+            too_long = scrambled_fraction(int(video_id), 'reject') < self.reject_ratio
+            items.append({'id': video_id,
+                          'contentDetails': {'duration': 'PT2H' if too_long else 'PT3M5S', 'definition': 'hd'},
+                          'snippet': {'liveBroadcastContent': 'none'}})
+        return {'items': items}
+
+
+class FakeDownloadError(Exception):
+    pass
+
+
+class FakeYoutubeDLSession:
+    def __init__(self, downloader, params):
+        self.downloader = downloader
+        self.params = params
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url, download=False, process=False):
+        video_id = main.video_id_from_url(url)
+        return {'id': video_id, 'title': f'video {video_id}', 'formats': []}
+
+    def process_ie_result(self, info_dict, download=True):
+        downloader = self.downloader
+        time.sleep(downloader.latency)
+        if scrambled_fraction(int(info_dict['id']), 'download') < downloader.failure_rate:
+            raise FakeDownloadError(f'ERROR: Video unavailable (fake download error of {info_dict["id"]})')
+        info_dict['ext'] = 'mp4' if self.params['format'] == 'worst' else 'webm'
+        file_path = self.prepare_filename(info_dict)
+        # Every video gets its own content, the media store would merge equal files.
+        header = f'{info_dict["id"]} {info_dict["ext"]}'.encode()
+        with open(file_path, 'wb') as media_file:
+            media_file.write(header + bytes(max(downloader.size - len(header), 0)))
+        with downloader.lock:
+            downloader.downloads += 1
+        return info_dict
+
+    def prepare_filename(self, info_dict):
+        return self.params['outtmpl'] % info_dict
+
+
+class FakeYoutubeDL:
+    """
+    A stub of the youtube_dl module: YoutubeDL(params) downloads files of size bytes that take latency seconds,
+    and failure_rate of the videos always fail.
+    """
+    # The helpers (sanitize_filename, ...) are the real ones.
+    utils = main.youtube_dl.utils
+
+    def __init__(self, latency=0.0, size=16 * 1024, failure_rate=0.0):
+        self.latency = latency
+        self.size = size
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.downloads = 0
+
+    def YoutubeDL(self, params):
+        return FakeYoutubeDLSession(self, params)
+
+
+def fake_ffmpeg(latency=0.0):
+    """
+    A stub of subprocess.run for the ffmpeg commands of extract_wav, it copies the input to the output.
+    """
+    def run(command, check=True):
+        time.sleep(latency)
+        shutil.copyfile(command[command.index('-i') + 1], command[-1])
+    return types.SimpleNamespace(run=run, CalledProcessError=subprocess.CalledProcessError)
+
+
+@contextmanager
+def offline(youtube, downloader, ffmpeg):
+    """
+    Replace the API client, youtube_dl and ffmpeg of main with the fakes while inside the context.
+    The rate limiters are replaced by ones without a rate limit, so the benchmarks measure the code and not
+    the limits of the real services (the retries still go through them).
+    """
+    saved = main.build, main.youtube_dl, main.subprocess, main.API_RATE_LIMITER, main.DOWNLOAD_RATE_LIMITER
+    main.build = lambda *args, **kwargs: youtube
+    main.youtube_dl = downloader
+    main.subprocess = ffmpeg
+    main.API_RATE_LIMITER = main.RateLimiter('api', rate=1e9, burst=1e9, retries=5, base_delay=0.01)
+    main.DOWNLOAD_RATE_LIMITER = main.RateLimiter('download', rate=1e9, burst=1e9, retries=3, base_delay=0.01)
+    try:
+        yield
+    finally:
+        main.build, main.youtube_dl, main.subprocess, main.API_RATE_LIMITER, main.DOWNLOAD_RATE_LIMITER = saved
+
+
+@contextmanager
+def timed_methods(cls, names, totals):
+    """
+    Add the time spent in the methods of cls to totals[name] while inside the context.
+    """
+    saved = {name: getattr(cls, name) for name in names}
+
+    def timed(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[name] = totals.get(name, 0.0) + time.perf_counter() - start
+        return wrapper
+
+    for name, method in saved.items():
+        setattr(cls, name, timed(name, method))
+    try:
+        yield
+    finally:
+        for name, method in saved.items():
+            setattr(cls, name, method)
+
+
+def folder_size(folder, pattern):
+    return sum(file_path.stat().st_size for file_path in Path(folder).glob(pattern))
+
+
+@contextmanager
+def measured(result):
+    """
+    Save the seconds and the peak traced memory of the code inside the context into result.
+    tracemalloc makes the code slower, so compare the times of runs that were all measured the same way.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        result['seconds'] = time.perf_counter() - start
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+
+def benchmark_search(sizes=(100, 10000, 100000), api_latency=0.0):
+    """
+    Page through searches of every size with get_youtube_urls.
+    Prints the time, the API calls per accepted video and the peak memory.
+    """
+    print('get_youtube_urls')
+    for n_results in sizes:
+        youtube = FakeYouTube(n_results, latency=api_latency)
+        result = dict()
+        with tempfile.TemporaryDirectory() as root:
+            database_path = Path(root).joinpath('bass Search')
+            os.makedirs(database_path)
+            with offline(youtube, FakeYoutubeDL(), fake_ffmpeg()), redirect_stdout(io.StringIO()):
+                with measured(result):
+                    urls = main.get_youtube_urls(database_path, 'bass', ['bass'], ['slap'])
+        api_calls = sum(youtube.calls.values())
+        print(f'{n_results:>7} results: {len(urls):>6} accepted in {result["seconds"]:7.2f} s, '
+              f'{api_calls / max(len(urls), 1):.3f} API calls per accepted video ({youtube.calls}), '
+              f'peak {result["peak_mb"]:7.1f} MB')
+
+
+def benchmark_slices(n_results=100000, result_cap=500, slices=((1, 1), (2, 2), (4, 4), (4, 16))):
+    """
+    Search a fake YouTube that, like the real one, stops paging a query after result_cap results,
+    split into (query variants, time windows) slices. Prints how many videos every split finds.
+    """
+    print(f'search slices, {n_results} results, {result_cap} results per query')
+    for n_queries, time_windows in slices:
+        youtube = FakeYouTube(n_results, result_cap=result_cap)
+        variants = [f'bass variant {index}' for index in range(1, n_queries)]
+        result = dict()
+        with tempfile.TemporaryDirectory() as root:
+            database_path = Path(root).joinpath('bass Search')
+            os.makedirs(database_path)
+            with offline(youtube, FakeYoutubeDL(), fake_ffmpeg()), redirect_stdout(io.StringIO()):
+                with measured(result):
+                    urls = main.get_youtube_urls(database_path, 'bass', ['bass'], ['slap'],
+                                                 query_variants=variants, time_windows=time_windows)
+        print(f'{n_queries:>3} queries x {time_windows:>3} windows: {len(urls):>6} accepted in '
+              f'{result["seconds"]:6.2f} s, {youtube.calls["search"]} search calls')
+
+
+def benchmark_scrape(sizes=(100, 10000, 100000), api_latency=0.0, download_latency=0.0, ffmpeg_latency=0.0,
+                     file_size=16 * 1024, failure_rate=0.01, max_downloads=8, max_ffmpeg_jobs=4):
+    """
+    Run scrape_audio end to end (search, pre-screen, download, convert, media store, ledger) for every size.
+    Prints videos/minute, API calls per downloaded video, the time spent in and the size of the ledger,
+    and the peak memory.
+    """
+    print(f'scrape_audio, {max_downloads} downloads / {max_ffmpeg_jobs} ffmpeg jobs, '
+          f'download latency {download_latency} s, {failure_rate:.0%} failed downloads')
+    for n_results in sizes:
+        youtube = FakeYouTube(n_results, latency=api_latency)
+        downloader = FakeYoutubeDL(latency=download_latency, size=file_size, failure_rate=failure_rate)
+        result = dict()
+        ledger_seconds = dict()
+        stats = RunStats()
+        with tempfile.TemporaryDirectory() as root:
+            database_path = Path(root).joinpath('bass Search')
+            with offline(youtube, downloader, fake_ffmpeg(ffmpeg_latency)), redirect_stdout(io.StringIO()):
+                with timed_methods(main.DownloadLedger, ('__contains__', 'add', 'export_csv'), ledger_seconds):
+                    with measured(result):
+                        main.scrape_audio(database_path, 'bass', ['bass'], ['slap'], max_downloads=max_downloads,
+                                          max_ffmpeg_jobs=max_ffmpeg_jobs, retries=0, trim=False, stats=stats)
+            ledger_bytes = folder_size(database_path, 'scanned_files.*')
+        counters = stats.report()['counters']
+        downloaded = counters.get('videos_downloaded', 0)
+        api_calls = sum(youtube.calls.values())
+        print(f'{n_results:>7} results: {downloaded:>6} downloaded in {result["seconds"]:7.2f} s '
+              f'({downloaded / (result["seconds"] / 60):9.0f} videos/minute), '
+              f'{api_calls / max(downloaded, 1):.3f} API calls per downloaded video, '
+              f'ledger {sum(ledger_seconds.values()):6.2f} s / {ledger_bytes / 1024:8.1f} KB, '
+              f'peak {result["peak_mb"]:7.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the scraping code.')
+    parser.add_argument('benchmark', nargs='?', default='all', choices=('keywords', 'search', 'slices', 'scrape', 'all'))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='The numbers of search results of the search and scrape benchmarks.')
+    parser.add_argument('--download-latency', type=float, default=0.0, help='Seconds every fake download takes.')
+    parser.add_argument('--failure-rate', type=float, default=0.01, help='The part of the downloads that fail.')
+    args = parser.parse_args()
+    if args.benchmark in ('keywords', 'all'):
+        benchmark_keyword_filter()
+    if args.benchmark in ('search', 'all'):
+        benchmark_search(args.sizes)
+    if args.benchmark in ('slices', 'all'):
+        benchmark_slices()
+    if args.benchmark in ('scrape', 'all'):
+        benchmark_scrape(args.sizes, download_latency=args.download_latency, failure_rate=args.failure_rate)
@@ -1,106 +1,1670 @@
 from __future__ import unicode_literals
-from office365.runtime.auth.authentication_context import AuthenticationContext
-from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.folders.folder import Folder
-from office365.sharepoint.files.file import File
-from googleapiclient.discovery import build
-from scipy.fftpack import fft
-from scipy.io import wavfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse, parse_qs
+import urllib.error
+import http.client
 from pathlib import Path
-import pandas as pd
-import numpy as np
-import youtube_dl
+import importlib.util
+import subprocess
+import socket
+import ssl
+import threading
+import tempfile
 import datetime
-import librosa
+import zoneinfo
+import argparse
+import sqlite3
+import shutil
+import uuid
+import hashlib
+import glob
 import pickle
+import random
+import copy
+import json
+import sys
 import html
+import time
+import re
+import csv
 import os
 
 
-def get_youtube_urls(database_path, search_term, must_have_in_title_or_description, must_not_have_in_title_or_description, pickle_exists_only_download=False):
+def lazy_import(name):
     """
-    To make it work you need to create google (Youtube) API key.
-    Returns a list of YouTube urls that match the search term.
+    Import a module on the first use of one of its attributes.
+    The heavy dependencies are imported like this, so the CLI (--help, ledger queries, ...) starts fast and
+    every subcommand only pays for the libraries it uses.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class MissingModule:
+    """
+    Stands for a module that isn't installed: main.py still imports, and the ImportError is raised when the
+    module is first used, so the subcommands that don't need it keep working.
     """
 
-    # Set the API key and service name, Idan's key.
-    API_KEY = ''
-    date_format = '%d_%m_%y'
-    current_date = datetime.datetime.now().strftime(date_format)
-    pickle_name = f'urls_{search_term}_{current_date}.pickle'
-
-    # First page of 50 videos (still not using it. first use in the while loop)
-    youtube = build('youtube', 'v3', developerKey=API_KEY)
-
-    # if pickle already exists, meaning the script failed yesterday
-    # so it load the last urls so that it wont add the same urls to urls dict.
-    if pickle_name in os.listdir(database_path):
-        with open(database_path.joinpath(pickle_name), 'rb') as pickle_file:
-            urls = pickle.load(pickle_file)
-    else:
-        urls = dict()
-    if pickle_exists_only_download:
-        return urls
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        raise ModuleNotFoundError(f'No module named {self.name!r}, install it to use {self.name}.{attribute}',
+                                  name=self.name)
+
+
+np = lazy_import('numpy')
+sf = lazy_import('soundfile')
+youtube_dl = lazy_import('youtube_dl')
+
 
-    nextPageToken = 'default'
-    limit_queries_reached = False
-    while nextPageToken:
-        request = youtube.search().list(q=search_term, part='snippet',
-                                        type='video',
-                                        maxResults=50,
-                                        pageToken=nextPageToken)
+def build(service_name, version, **kwargs):
+    """
+    googleapiclient's build(), imported on the first call.
+    """
+    from googleapiclient.discovery import build as discovery_build
+    return discovery_build(service_name, version, **kwargs)
+
+
+class RunStats:
+    """
+    Timings and counters of the stages of a run: API page latency, quota units, filter hit ratio,
+    download bytes/sec, ffmpeg transcode time, upload time, failures by category, ...
+    Every run (scrape_audio / run_batch) has its own RunStats that the functions of the run record into
+    (see run_stats()), and writes it as a json report (and optionally Prometheus text or csv) at the end of the run,
+    also when the run fails. It is safe to record from many threads.
+    """
+
+    # The RunStats that every thread records into, see active().
+    current = threading.local()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            # stage -> [count, total seconds, max seconds]
+            self.timings = dict()
+            self.counters = dict()
+            # 'stage:ErrorType' -> count
+            self.failures = dict()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
         try:
-            res = request.execute()
-        # Meaning reached limit queries for today.
-        except Exception as e:
-            print(e)
-            limit_queries_reached = True
-            break
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - start)
+
+    def add_timing(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(stage, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def failure(self, stage, error):
+        category = f'{stage}:{getattr(error, "category", None) or classify_error(error)}'
+        with self.lock:
+            self.failures[category] = self.failures.get(category, 0) + 1
+
+    def ratio(self, numerator, denominator):
+        return self.counters.get(numerator, 0) / self.counters[denominator] if self.counters.get(denominator) else None
+
+    def report(self):
+        """
+        Return the report as a dict (the content of the json report).
+        """
+        with self.lock:
+            elapsed = time.time() - self.started_at
+            stages = {stage: {'count': count, 'total_seconds': total, 'mean_seconds': total / count,
+                              'max_seconds': longest}
+                      for stage, (count, total, longest) in self.timings.items()}
+            download_seconds = self.timings.get('download', [0, 0.0, 0.0])[1]
+            return {
+                'started_at': datetime.datetime.fromtimestamp(self.started_at).isoformat(),
+                'elapsed_seconds': elapsed,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'failures': dict(self.failures),
+                'derived': {
+                    'filter_hit_ratio': self.ratio('keyword_matches', 'search_results'),
+                    'prescreen_accept_ratio': self.ratio('prescreen_accepted', 'prescreen_checked'),
+                    'search_cache_hit_ratio': self.ratio('search_cache_hits', 'search_pages'),
+                    # Per download worker, and for the whole run.
+                    'download_bytes_per_second': (self.counters.get('download_bytes', 0) / download_seconds
+                                                  if download_seconds else None),
+                    'run_download_bytes_per_second': self.counters.get('download_bytes', 0) / elapsed,
+                    'videos_per_minute': self.counters.get('videos_downloaded', 0) / (elapsed / 60),
+                },
+            }
+
+    def write_json(self, report_path):
+        with open(report_path, 'w', encoding='utf-8') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def write_prometheus(self, report_path):
+        """
+        Write the report in the Prometheus text format (e.g. for the node exporter textfile collector).
+        """
+        report = self.report()
+        lines = ['# TYPE youtube_scrape_stage_seconds_total counter',
+                 '# TYPE youtube_scrape_stage_runs_total counter']
+        for stage, timing in report['stages'].items():
+            lines.append(f'youtube_scrape_stage_seconds_total{{stage="{stage}"}} {timing["total_seconds"]}')
+            lines.append(f'youtube_scrape_stage_runs_total{{stage="{stage}"}} {timing["count"]}')
+        for name, value in report['counters'].items():
+            lines.append(f'# TYPE youtube_scrape_{name}_total counter')
+            lines.append(f'youtube_scrape_{name}_total {value}')
+        lines.append('# TYPE youtube_scrape_failures_total counter')
+        for category, value in report['failures'].items():
+            stage, error = category.split(':', 1)
+            lines.append(f'youtube_scrape_failures_total{{stage="{stage}",error="{error}"}} {value}')
+        for name, value in report['derived'].items():
+            if value is not None:
+                lines.append(f'# TYPE youtube_scrape_{name} gauge')
+                lines.append(f'youtube_scrape_{name} {value}')
+        with open(report_path, 'w', encoding='utf-8') as report_file:
+            report_file.write('\n'.join(lines) + '\n')
+
+    def write_csv(self, report_path):
+        """
+        Write the report as rows of (kind, name, value, count, total_seconds, mean_seconds, max_seconds).
+        """
+        report = self.report()
+        with open(report_path, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['kind', 'name', 'value', 'count', 'total_seconds', 'mean_seconds', 'max_seconds'])
+            for stage, timing in report['stages'].items():
+                writer.writerow(['stage', stage, '', timing['count'], timing['total_seconds'],
+                                 timing['mean_seconds'], timing['max_seconds']])
+            for name, value in report['counters'].items():
+                writer.writerow(['counter', name, value, '', '', '', ''])
+            for category, value in report['failures'].items():
+                writer.writerow(['failure', category, value, '', '', '', ''])
+            for name, value in report['derived'].items():
+                writer.writerow(['derived', name, value, '', '', '', ''])
+
+    @contextmanager
+    def active(self):
+        """
+        Record what the calling thread records (with run_stats()) into this instance until the block ends.
+        The thread pools of the run pass bind() as their initializer, so their workers record into it too.
+        """
+        previous = getattr(RunStats.current, 'stats', None)
+        RunStats.current.stats = self
+        try:
+            yield self
+        finally:
+            RunStats.current.stats = previous
 
-        for video in res['items']:
-            lower_case_title = video['snippet']['title'].lower()
-            lower_case_description = video['snippet']['description'].lower()
-
-            # check if any word in must_have_in_title are present in the title or description
-            # continue if found.
-            if must_have_in_title_or_description:
-                for word in must_have_in_title_or_description:
-                    if (word in lower_case_title) or (word in lower_case_description):
+    def bind(self):
+        RunStats.current.stats = self
+
+    def write(self, report_dir, formats=('json',)):
+        """
+        Write the report to run_report.json (and run_report.prom / run_report.csv) in report_dir.
+        """
+        writers = {'json': self.write_json, 'prometheus': self.write_prometheus, 'csv': self.write_csv}
+        extensions = {'json': 'json', 'prometheus': 'prom', 'csv': 'csv'}
+        for report_format in formats:
+            writers[report_format](report_dir.joinpath(f'run_report.{extensions[report_format]}'))
+        print(f'Run report saved to {report_dir.joinpath("run_report.json")}')
+
+
+# What is recorded outside of a run (e.g. by a search without downloads).
+RUN_STATS = RunStats()
+
+
+def run_stats():
+    """
+    The RunStats of the run of the calling thread, or RUN_STATS outside of a run.
+    """
+    return getattr(RunStats.current, 'stats', None) or RUN_STATS
+
+
+QUOTA_ERROR_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+PERMANENT_ERROR_MESSAGES = ('Video unavailable', 'Private video', 'This video is not available', 'copyright',
+                            'has been terminated', 'Sign in to confirm your age', 'members-only',
+                            'This live event will begin', 'Unsupported URL')
+TRANSIENT_HTTP_STATUSES = (408, 429, 500, 502, 503, 504)
+# The network errors that are worth retrying. urllib's, http.client's and ssl's errors and socket timeouts,
+# and the messages youtube_dl wraps them in.
+NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, urllib.error.URLError,
+                  http.client.HTTPException, ssl.SSLError)
+# httplib2 (used by googleapiclient) raises its own error when the server can't be resolved.
+HTTPLIB2_NETWORK_ERRORS = ('ServerNotFoundError',)
+TRANSIENT_ERROR_MESSAGES = ('timed out', 'Connection reset', 'Connection refused', 'Remote end closed',
+                            'IncompleteRead', 'Temporary failure in name resolution', 'urlopen error')
+
+
+def classify_error(error):
+    """
+    Classify an error of an API call or a download as:
+    - 'quota': the daily API quota is used, nothing will work until tomorrow.
+    - 'transient': throttling (429, rateLimitExceeded), server errors (5xx) and network errors, worth retrying.
+    - 'permanent': bad requests (other 4xx), unavailable/private videos and failed conversions, retrying won't help.
+    Errors that aren't recognized are 'permanent', so a bug (TypeError, KeyError, ...) isn't retried and doesn't
+    slow the shared rate down.
+    """
+    return recognized_error_category(error) or 'permanent'
+
+
+def recognized_error_category(error):
+    """
+    The category of classify_error, or None if the error isn't recognized.
+    """
+    # youtube_dl wraps the original error of a download.
+    cause_category = None
+    cause = getattr(error, 'exc_info', None)
+    if cause and cause[1] is not None and cause[1] is not error:
+        cause_category = recognized_error_category(cause[1])
+        if cause_category in ('quota', 'permanent'):
+            return cause_category
+    content = getattr(error, 'content', b'')
+    text = str(error) + (content.decode('utf-8', 'replace') if isinstance(content, bytes) else str(content))
+    if any(reason in text for reason in QUOTA_ERROR_REASONS):
+        return 'quota'
+    if 'rateLimitExceeded' in text:
+        return 'transient'
+    # googleapiclient's HttpError has resp.status, urllib's HTTPError has code, youtube_dl only has the message.
+    status = getattr(getattr(error, 'resp', None), 'status', None) or getattr(error, 'code', None)
+    match = re.search(r'HTTP Error (\d{3})', text)
+    if match:
+        status = int(match.group(1))
+    if isinstance(status, str) and status.isdigit():
+        status = int(status)
+    if isinstance(status, int) and 400 <= status < 600:
+        return 'transient' if status in TRANSIENT_HTTP_STATUSES else 'permanent'
+    if isinstance(error, subprocess.CalledProcessError) or any(message in text for message in PERMANENT_ERROR_MESSAGES):
+        return 'permanent'
+    if (isinstance(error, NETWORK_ERRORS) or type(error).__name__ in HTTPLIB2_NETWORK_ERRORS
+            or any(message in text for message in TRANSIENT_ERROR_MESSAGES)):
+        return 'transient'
+    return cause_category
+
+
+class RateLimiter:
+    """
+    A token bucket with jittered exponential retries, shared by all the threads that call one service.
+
+    Calls start at most rate per second (with bursts of up to burst calls). A transient error halves the rate
+    (down to min_rate) and is retried after a random wait of up to base_delay * 2 ** attempt seconds,
+    and every successful call raises the rate back towards max_rate, so the workers settle on the highest rate
+    the service sustains without throttling. Quota and permanent errors are raised at once.
+    The errors that are raised get a category attribute (see classify_error).
+
+    Parameters:
+    - name (str): The name of the service in the run report ('{name}_retries', '{name}_rate_limit_wait').
+    - rate (float): The highest rate, in calls per second.
+    - burst (int, optional): How many calls may start at once after a quiet period. Defaults to 1.
+    - retries (int, optional): How many times a transient error is retried. Defaults to 3.
+    - base_delay (float, optional): The wait before the first retry, it doubles on every retry. Defaults to 1.
+    - max_delay (float, optional): The longest wait before a retry. Defaults to 60.
+    - min_rate (float, optional): The rate never goes below it. Defaults to rate / 16.
+    """
+
+    def __init__(self, name, rate, burst=1, retries=3, base_delay=1, max_delay=60, min_rate=None):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.burst = burst
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a call may start.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+        if waited:
+            run_stats().add_timing(f'{self.name}_rate_limit_wait', waited)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def call(self, function, *args, retries=None, base_delay=None):
+        """
+        Call function(*args) when the bucket allows it, retrying transient errors. Returns its result.
+        retries and base_delay override the limiter's for this call.
+        """
+        retries = self.retries if retries is None else retries
+        base_delay = self.base_delay if base_delay is None else base_delay
+        for attempt in range(retries + 1):
+            self.acquire()
+            try:
+                result = function(*args)
+            except Exception as e:
+                e.category = classify_error(e)
+                if e.category != 'transient' or attempt == retries:
+                    raise
+                self.slow_down()
+                run_stats().count(f'{self.name}_retries')
+                wait_seconds = random.uniform(0, min(self.max_delay, base_delay * 2 ** attempt))
+                print(f'{self.name} call failed ({e}), retrying in {wait_seconds:.1f} seconds')
+                time.sleep(wait_seconds)
+                continue
+            self.speed_up()
+            return result
+
+
+# Shared by all the searches and download workers of the process, so together they stay under YouTube's limits.
+API_RATE_LIMITER = RateLimiter('api', rate=5, burst=10, retries=5, base_delay=1)
+DOWNLOAD_RATE_LIMITER = RateLimiter('download', rate=2, burst=4, retries=3, base_delay=5)
+
+
+def normalize_text(text, casefold=False):
+    """
+    Prepare a title/description/keyword for matching.
+    By default only .lower() is applied, like the original filter did. The API returns html escaped snippets
+    (e.g. "&#39;"), with casefold=True they are unescaped and then casefolded.
+    """
+    if casefold:
+        # html.unescape is slow even when there is nothing to unescape, and most snippets have no entities.
+        return (html.unescape(text) if '&' in text else text).casefold()
+    return text.lower()
+
+
+def keywords_pattern(keywords):
+    """
+    Build one regex alternation for all the keywords, arranged as a trie ('bass', 'bassoon' -> 'bass(?:oon)?'),
+    so the regex engine doesn't try every keyword from scratch at every position of the text.
+    """
+    trie = dict()
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, dict())
+        node[''] = dict()
+    return trie_node_pattern(trie)
+
+
+def trie_node_pattern(node):
+    keyword_ends_here = '' in node
+    branches = [re.escape(char) + trie_node_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not keyword_ends_here:
+        return branches[0]
+    pattern = '(?:' + '|'.join(branches) + ')'
+    return pattern + '?' if keyword_ends_here else pattern
+
+
+class KeywordFilter:
+    """
+    The must have / must not have filter of the title and description of a video.
+
+    Each keyword list is prepared once into a matcher and every snippet is scanned once. Short lists are checked
+    with plain substring search (the fastest for up to ~200 keywords), long lists and whole word matching are
+    compiled into a single trie shaped regex so the cost doesn't grow with the number of keywords.
+
+    Parameters:
+    - must_have_in_title_or_description (list of str): At least one of them must appear. Empty list accepts all.
+    - must_not_have_in_title_or_description (list of str): None of them may appear.
+    - whole_words (bool, optional): Match keywords only as whole words ('man' won't match 'manual'). Defaults to False,
+      which matches substrings like the original filter.
+    - casefold (bool, optional): Unescape html and casefold the text and the keywords. Defaults to False, which
+      lowercases them like the original filter, so the same videos are accepted.
+    Empty keywords are ignored (an empty string is in every text, so it used to reject or accept everything).
+    """
+    # Above this number of keywords a single regex is faster than one substring search per keyword
+    # (measured with benchmark.py keywords: they break even at ~200 keywords).
+    max_substring_keywords = 200
+
+    def __init__(self, must_have_in_title_or_description, must_not_have_in_title_or_description,
+                 whole_words=False, casefold=False):
+        self.casefold = casefold
+        # str.lower directly when there is nothing else to do, it saves a function call per snippet.
+        self.normalize = normalize_text if casefold else str.lower
+        self.must_have = self.compile(must_have_in_title_or_description, whole_words)
+        self.must_not_have = self.compile(must_not_have_in_title_or_description, whole_words)
+        if not callable(self.must_have) and not callable(self.must_not_have):
+            # Only short lists: the original loop, without the dispatch of matches(), is the fastest.
+            self.matches = self.substring_matcher(self.must_have or (), self.must_not_have or ())
+
+    def compile(self, keywords, whole_words):
+        """
+        Returns None for no keywords, a tuple of keywords for substring search or a function
+        (title, description) -> True if the regex is found in either.
+        The title and description are searched separately, so a keyword can't match across their boundary.
+        """
+        keywords = dict.fromkeys(normalize_text(keyword, self.casefold) for keyword in keywords or [] if keyword)
+        if not keywords:
+            return None
+        if not whole_words and len(keywords) <= self.max_substring_keywords:
+            # In the given order, like the original loop (the common keywords are usually first).
+            return tuple(keywords)
+        pattern = keywords_pattern(keywords)
+        if whole_words:
+            pattern = rf'(?<!\w){pattern}(?!\w)'
+        search = re.compile(pattern).search
+        return lambda title, description: search(title) is not None or search(description) is not None
+
+    def substring_matcher(self, must_have, must_not_have):
+        """
+        Returns matches() for keyword tuples, with everything it needs in local variables.
+        """
+        normalize = self.normalize
+
+        def matches(title, description):
+            title = normalize(title)
+            description = normalize(description)
+            if must_have:
+                for keyword in must_have:
+                    if keyword in title or keyword in description:
                         break
                 else:
-                    continue
+                    return False
+            for keyword in must_not_have:
+                if keyword in title or keyword in description:
+                    return False
+            return True
+        return matches
+
+    def matches(self, title, description):
+        """
+        Return True if the video passes the filter.
+        """
+        must_have, must_not_have = self.must_have, self.must_not_have
+        if must_have is None and must_not_have is None:
+            return True
+        title = self.normalize(title)
+        description = self.normalize(description)
+        # The substring loops are inline: for a few keywords a function call per list costs as much as the search.
+        if isinstance(must_have, tuple):
+            for keyword in must_have:
+                if keyword in title or keyword in description:
+                    break
+            else:
+                return False
+        elif must_have is not None and not must_have(title, description):
+            return False
+        if isinstance(must_not_have, tuple):
+            for keyword in must_not_have:
+                if keyword in title or keyword in description:
+                    return False
+        elif must_not_have is not None and must_not_have(title, description):
+            return False
+        return True
+
+
+class SearchCache:
+    """
+    On-disk cache of raw YouTube API result pages, one json file per page.
 
-            # check if any word in must_not_have_in_title_or_description is present in the title or description.
-            # break if yes.
-            if must_not_have_in_title_or_description:
-                found_wrong_word = False
-                for word in must_not_have_in_title_or_description:
-                    if (word in lower_case_title) or (word in lower_case_description):
-                        found_wrong_word = True
-                        break
-            if found_wrong_word:
-                continue
+    Pages are keyed by all the request parameters (query, pageToken, ...), so re-running a search with
+    different must have / must not have keywords replays the cached pages without spending API quota.
+    Pages older than ttl_seconds are fetched again, and the least recently used pages are evicted when
+    the cache grows over max_bytes.
 
-            # if both checks pass, add the video URL and title to the urls dictionary
-            video_id = video['id']['videoId']
-            urls[f'https://www.youtube.com/watch?v={video_id}'] = video['snippet']['title']
+    Parameters:
+    - cache_dir (Path): The directory of the cache. It can be shared by many searches.
+    - ttl_seconds (float, optional): How long a cached page is valid. Defaults to 7 days.
+    - max_bytes (int, optional): The size limit of the cache directory. Defaults to 500 MB.
+    """
 
-        if 'nextPageToken' not in res or limit_queries_reached:
-            break
+    def __init__(self, cache_dir, ttl_seconds=7 * 24 * 60 * 60, max_bytes=500 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(page_path.stat().st_size for page_path in cache_dir.glob('*.json'))
+
+    def page_path(self, params):
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        return self.cache_dir.joinpath(f'{key}.json')
+
+    def get(self, params):
+        """
+        Return the cached page of the request parameters, or None if it isn't cached or expired.
+        """
+        page_path = self.page_path(params)
+        try:
+            if time.time() - page_path.stat().st_mtime <= self.ttl_seconds:
+                with open(page_path, encoding='utf-8') as page_file:
+                    page = json.load(page_file)
+                # The access time marks the page as recently used for the eviction.
+                os.utime(page_path, (time.time(), page_path.stat().st_mtime))
+                with self.lock:
+                    self.hits += 1
+                run_stats().count('search_cache_hits')
+                return page
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, params, page):
+        """
+        Save the page of the request parameters and evict old pages if the cache is too big.
+        """
+        page_path = self.page_path(params)
+        # A unique temp file, the same page can be written by several slices or searches at once.
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.cache_dir, prefix=page_path.stem,
+                                         suffix='.tmp', delete=False) as page_file:
+            try:
+                json.dump(page, page_file)
+            except BaseException:
+                page_file.close()
+                os.remove(page_file.name)
+                raise
+        old_size = page_path.stat().st_size if page_path.exists() else 0
+        os.replace(page_file.name, page_path)
+        with self.lock:
+            self.total_bytes += page_path.stat().st_size - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used pages until the cache is back under 90% of max_bytes.
+        """
+        pages = sorted(self.cache_dir.glob('*.json'), key=lambda page_path: page_path.stat().st_atime)
+        for page_path in pages:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            size = page_path.stat().st_size
+            os.remove(page_path)
+            self.total_bytes -= size
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0
+
+    def report(self):
+        return (f'search cache: {self.hits} hits, {self.misses} misses '
+                f'({self.hit_rate():.0%} hit rate), {self.total_bytes / (1024 * 1024):.1f} MB')
+
+
+# The quota units that one search().list call costs.
+SEARCH_LIST_COST = 100
+# The YouTube API quota resets at midnight Pacific time.
+QUOTA_TIME_ZONE = 'America/Los_Angeles'
+
+
+def quota_day():
+    """
+    The date of the current quota day, e.g. '2024-05-01'.
+    """
+    return datetime.datetime.now(zoneinfo.ZoneInfo(QUOTA_TIME_ZONE)).date().isoformat()
 
-        nextPageToken = res['nextPageToken']
 
-    # Pickle the urls that found. There is a limit for each day.
-    # So if it found 600 files and then failed,
-    # it will continue the next day.
-    # The search is looking for different videos names.
-    with open(database_path.joinpath(pickle_name), 'wb') as f:
-        pickle.dump(urls, f)
+def search_key(database_path):
+    """
+    The name of a search in the structures shared by many searches (quota shares, batch state): its resolved folder,
+    so two searches with the same folder name under different roots are kept apart.
+    """
+    return str(Path(database_path).resolve())
 
+
+class QuotaScheduler:
+    """
+    Splits the daily YouTube API quota between the searches of a batch.
+
+    Every search may spend an equal share of the units that the finished searches didn't use,
+    so a search that runs out of pages early leaves its share to the others.
+    The units spent today are saved in state_path, so a batch that is run again the same day
+    doesn't spend the quota twice, and the counters start over on the next day.
+
+    Parameters:
+    - state_path (Path): The json file of the spent units.
+    - search_names (list of str): The searches that share the quota.
+    - daily_units (int, optional): The API quota of a day. Defaults to 10000 (the default YouTube API quota).
+    The day is the date in YouTube's time zone (Pacific time), when the quota resets, not the local date.
+    """
+
+    def __init__(self, state_path, search_names, daily_units=10000):
+        self.state_path = state_path
+        self.search_names = list(search_names)
+        self.daily_units = daily_units
+        self.finished = set()
+        self.lock = threading.Lock()
+        self.date = quota_day()
+        self.spent = dict()
+        if state_path.exists():
+            with open(state_path, encoding='utf-8') as state_file:
+                state = json.load(state_file)
+            if state.get('date') == self.date:
+                self.spent = state.get('spent', dict())
+
+    def share(self):
+        active = [name for name in self.search_names if name not in self.finished]
+        finished_spent = sum(self.spent.get(name, 0) for name in self.finished)
+        return (self.daily_units - finished_spent) / max(len(active), 1)
+
+    def acquire(self, search_name, units=SEARCH_LIST_COST):
+        """
+        Return True and count the units if search_name may spend them now, otherwise False.
+        """
+        with self.lock:
+            today = quota_day()
+            if today != self.date:
+                self.date, self.spent = today, dict()
+            if sum(self.spent.values()) + units > self.daily_units:
+                return False
+            if self.spent.get(search_name, 0) + units > self.share():
+                return False
+            self.spent[search_name] = self.spent.get(search_name, 0) + units
+            self.save()
+            return True
+
+    def finish(self, search_name):
+        """
+        Mark that search_name won't spend any more units, so its unused share goes to the other searches.
+        """
+        with self.lock:
+            self.finished.add(search_name)
+
+    def save(self):
+        temp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump({'date': self.date, 'spent': self.spent}, state_file)
+        os.replace(temp_path, self.state_path)
+
+
+def parse_iso_duration(duration):
+    """
+    Return the seconds of an ISO 8601 duration like 'PT1H2M3S' (the format of the API), or None.
+    """
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', duration or '')
+    if not match:
+        return None
+    days, hours, minutes, seconds = (int(value or 0) for value in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class MetadataPrescreen:
+    """
+    Checks the duration, definition and live status of the videos before anything is downloaded,
+    so bandwidth and ffmpeg time go only to usable clips.
+
+    The metadata is fetched with videos().list, 50 ids per call (1 quota unit per call), and cached in a SQLite
+    file for ttl_seconds, so a video is looked up once even if many searches find it.
+    The videos that couldn't be checked (no quota, API errors) are never accepted unchecked: they are deferred,
+    and the search saves them with defer() to check them on its next run.
+
+    Parameters:
+    - cache_path (Path): The SQLite file of the metadata cache.
+    - max_duration_seconds (float, optional): Longer videos are skipped. Defaults to 30 minutes, None for no limit.
+    - min_duration_seconds (float, optional): Shorter videos are skipped. Defaults to 0.
+    - allow_live (bool, optional): If False (default), live and upcoming streams are skipped.
+    - definition (str, optional): 'hd' or 'sd' to keep only that definition. Defaults to None (any).
+    - ttl_seconds (float, optional): How long the cached metadata is used, a live stream or an unavailable video
+      may change. Defaults to 7 days.
+    """
+
+    def __init__(self, cache_path, max_duration_seconds=30 * 60, min_duration_seconds=0, allow_live=False,
+                 definition=None, ttl_seconds=7 * 24 * 60 * 60):
+        self.max_duration_seconds = max_duration_seconds
+        self.min_duration_seconds = min_duration_seconds
+        self.allow_live = allow_live
+        self.definition = definition
+        self.ttl_seconds = ttl_seconds
+        self.accepted = 0
+        self.rejected = 0
+        self.deferred = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS video_metadata '
+                                '(video_id TEXT PRIMARY KEY, metadata TEXT, fetched_at TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS deferred_videos '
+                                '(search TEXT, video_id TEXT, title TEXT, deferred_at TEXT, '
+                                'PRIMARY KEY (search, video_id))')
+        self.connection.commit()
+
+    def cached_metadata(self, video_ids):
+        fresh_since = (datetime.datetime.now() - datetime.timedelta(seconds=self.ttl_seconds)).isoformat()
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT video_id, metadata FROM video_metadata WHERE video_id IN ({",".join("?" * len(video_ids))}) '
+                f'AND fetched_at >= ?', [*video_ids, fresh_since]).fetchall()
+        return {video_id: json.loads(metadata) for video_id, metadata in rows}
+
+    def fetch_metadata(self, youtube, video_ids):
+        """
+        Fetch the metadata of up to 50 video ids with one videos().list call and cache it.
+        Videos that the API didn't return (deleted or private) are cached as unavailable.
+        """
+        request = youtube.videos().list(part='contentDetails,snippet', id=','.join(video_ids), maxResults=50)
+
+        def execute():
+            # Every attempt costs quota, also the ones that fail.
+            run_stats().count('quota_units', 1)
+            return request.execute()
+        with run_stats().timer('api_videos_list'):
+            res = API_RATE_LIMITER.call(execute)
+        metadata = {video_id: {'available': False} for video_id in video_ids}
+        for video in res['items']:
+            metadata[video['id']] = {
+                'available': True,
+                'duration': parse_iso_duration(video['contentDetails'].get('duration')),
+                'definition': video['contentDetails'].get('definition'),
+                'live': video['snippet'].get('liveBroadcastContent', 'none'),
+            }
+        fetched_at = datetime.datetime.now().isoformat()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO video_metadata VALUES (?, ?, ?)',
+                                        [(video_id, json.dumps(video_metadata), fetched_at)
+                                         for video_id, video_metadata in metadata.items()])
+            self.connection.commit()
+        return metadata
+
+    def accepts(self, metadata):
+        if not metadata['available']:
+            return False
+        if not self.allow_live and metadata['live'] != 'none':
+            return False
+        if self.definition and metadata['definition'] != self.definition:
+            return False
+        duration = metadata['duration']
+        if duration is None:
+            return True
+        if self.max_duration_seconds is not None and duration > self.max_duration_seconds:
+            return False
+        return duration >= self.min_duration_seconds
+
+    def filter(self, youtube, video_ids, quota_scheduler=None, quota_name=None):
+        """
+        Return the video ids (in their order) that pass the limits, and the ids that couldn't be checked
+        because their metadata couldn't be fetched (no quota, API errors). Those aren't accepted.
+        """
+        metadata = self.cached_metadata(video_ids)
+        missing = [video_id for video_id in video_ids if video_id not in metadata]
+        for start in range(0, len(missing), 50):
+            batch = missing[start:start + 50]
+            if quota_scheduler is not None and not quota_scheduler.acquire(quota_name, units=1):
+                print('No quota for the metadata pre-screen, the videos are deferred to the next run')
+                break
+            try:
+                metadata.update(self.fetch_metadata(youtube, batch))
+            except Exception as e:
+                print(f'Couldn\'t pre-screen the videos, they are deferred to the next run: {e}')
+                run_stats().failure('api_videos', e)
+                break
+        deferred = [video_id for video_id in video_ids if video_id not in metadata]
+        accepted = [video_id for video_id in video_ids if video_id in metadata and self.accepts(metadata[video_id])]
+        with self.lock:
+            self.accepted += len(accepted)
+            self.deferred += len(deferred)
+            self.rejected += len(video_ids) - len(accepted) - len(deferred)
+        run_stats().count('prescreen_checked', len(video_ids) - len(deferred))
+        run_stats().count('prescreen_accepted', len(accepted))
+        run_stats().count('prescreen_deferred', len(deferred))
+        return accepted, deferred
+
+    def defer(self, search, titles):
+        """
+        Save the videos that search couldn't check, titles is a dict of video id -> title.
+        """
+        deferred_at = datetime.datetime.now().isoformat()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO deferred_videos VALUES (?, ?, ?, ?)',
+                                        [(search, video_id, title, deferred_at) for video_id, title in titles.items()])
+            self.connection.commit()
+
+    def deferred_videos(self, search):
+        """
+        Return the videos that search deferred, as a dict of video id -> title.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT video_id, title FROM deferred_videos WHERE search = ? '
+                                           'ORDER BY deferred_at', (search,)).fetchall()
+        return dict(rows)
+
+    def undefer(self, search, video_ids):
+        """
+        Forget the deferred videos of search that were checked.
+        """
+        with self.lock:
+            self.connection.executemany('DELETE FROM deferred_videos WHERE search = ? AND video_id = ?',
+                                        [(search, video_id) for video_id in video_ids])
+            self.connection.commit()
+
+    def report(self):
+        return (f'pre-screen: {self.accepted} videos accepted, {self.rejected} skipped by duration/definition/live, '
+                f'{self.deferred} deferred to the next run')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def load_urls_checkpoint(pickle_path):
+    """
+    Load the urls dict of a pickle checkpoint of the runs before VideoIndex.
+    The file is a sequence of pickled dicts (one per result page), older runs saved a single dict.
+    A record that was cut in the middle by a crash is ignored (unpickling a truncated record can raise
+    more or less anything, not only EOFError/UnpicklingError).
+    """
+    urls = dict()
+    if not pickle_path.exists():
+        return urls
+    with open(pickle_path, 'rb') as pickle_file:
+        while True:
+            try:
+                urls.update(pickle.load(pickle_file))
+            except EOFError:
+                break
+            except Exception as e:
+                print(f'Ignoring the rest of {pickle_path}, it ends with a damaged record ({e!r})')
+                break
     return urls
 
 
-def downloaded_from_youtube(database_path, url, with_video=False):
+class VideoIndex:
+    """
+    An index of the videos that the searches found, shared by all the searches in the same folder.
+
+    It is a SQLite file keyed by the 11 character video id, with the title, a snippet of the description,
+    the channel (saved once per channel) and the time the video was first seen, and the videos every search
+    accepted and when. Every result page is one committed transaction, so a crash loses at most the page that
+    was being handled, and a search resumes by loading only the ids it found today.
+
+    Parameters:
+    - index_path (Path): The SQLite file of the index.
+    """
+
+    description_length = 200
+
+    def __init__(self, index_path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(index_path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # A commit is still atomic, it is only not flushed to the disk on every page.
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS channels (channel_id TEXT PRIMARY KEY, title TEXT) '
+                                'WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, title TEXT, '
+                                'description TEXT, channel_id TEXT, first_seen TEXT) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS found (search TEXT, video_id TEXT, found_at TEXT, '
+                                'PRIMARY KEY (search, video_id)) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS imported_checkpoints (path TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS search_windows (search TEXT PRIMARY KEY, '
+                                'published_before TEXT)')
+        self.connection.commit()
+
+    def add_page(self, search, videos, accepted_ids):
+        """
+        Save the videos of a search result page (the 'items' of the response) and the ids that search accepted.
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        channels = dict()
+        rows = []
+        for video in videos:
+            snippet = video['snippet']
+            channel_id = snippet.get('channelId') or snippet.get('channelTitle')
+            channels[channel_id] = snippet.get('channelTitle')
+            rows.append((video['id']['videoId'], snippet['title'],
+                         snippet.get('description', '')[:self.description_length], channel_id, now))
+        with self.lock:
+            self.connection.executemany('INSERT OR IGNORE INTO channels VALUES (?, ?)', channels.items())
+            # Videos imported from the pickle checkpoints only have a title.
+            self.connection.executemany('INSERT INTO videos VALUES (?, ?, ?, ?, ?) ON CONFLICT (video_id) DO UPDATE '
+                                        'SET description = coalesce(description, excluded.description), '
+                                        'channel_id = coalesce(channel_id, excluded.channel_id)', rows)
+            self.connection.executemany('INSERT OR IGNORE INTO found VALUES (?, ?, ?)',
+                                        [(search, video_id, now) for video_id in accepted_ids])
+            self.connection.commit()
+
+    def found(self, search, since=None):
+        """
+        Return (video id, title) of the videos search accepted since the datetime since (default: all of them).
+        """
+        query = 'SELECT found.video_id, videos.title FROM found JOIN videos USING (video_id) WHERE found.search = ?'
+        params = [search]
+        if since is not None:
+            query += ' AND found.found_at >= ?'
+            params.append(since.isoformat(timespec='seconds'))
+        with self.lock:
+            return self.connection.execute(query + ' ORDER BY found.found_at', params).fetchall()
+
+    def query(self, search=None, since=None, text=None, channel=None, limit=None):
+        """
+        Return (video id, title, channel, first seen, searches) of the indexed videos, filtered by the search
+        that found them, the first seen datetime, a text in the title/description and the channel title.
+        """
+        conditions, params = [], []
+        if search is not None:
+            conditions.append('video_id IN (SELECT video_id FROM found WHERE search = ?)')
+            params.append(search)
+        if since is not None:
+            conditions.append('first_seen >= ?')
+            params.append(since.isoformat(timespec='seconds'))
+        if text is not None:
+            conditions.append('(videos.title LIKE ? OR description LIKE ?)')
+            params += [f'%{text}%'] * 2
+        if channel is not None:
+            conditions.append('channels.title LIKE ?')
+            params.append(f'%{channel}%')
+        query = ('SELECT video_id, videos.title, channels.title, first_seen, '
+                 '(SELECT group_concat(search, ", ") FROM found WHERE found.video_id = videos.video_id) '
+                 'FROM videos LEFT JOIN channels USING (channel_id)')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY first_seen'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def import_checkpoints(self, search, database_path, search_term):
+        """
+        Import the urls of the pickle checkpoints (urls_{search_term}_{day}.pickle) of the runs before the index.
+        Every file is imported once, the found time is the day in its name.
+        """
+        for pickle_path in database_path.glob(f'urls_{glob.escape(search_term)}_*.pickle'):
+            with self.lock:
+                if self.connection.execute('SELECT 1 FROM imported_checkpoints WHERE path = ?',
+                                           (str(pickle_path),)).fetchone():
+                    continue
+            try:
+                day = datetime.datetime.strptime('_'.join(pickle_path.stem.rsplit('_', 3)[1:]), '%d_%m_%y')
+            except ValueError:
+                continue
+            found_at = day.isoformat(timespec='seconds')
+            urls = load_urls_checkpoint(pickle_path)
+            ids = [(video_id_from_url(url), title) for url, title in urls.items()]
+            with self.lock:
+                self.connection.executemany('INSERT OR IGNORE INTO videos (video_id, title, first_seen) '
+                                            'VALUES (?, ?, ?)', [(video_id, title, found_at) for video_id, title in ids])
+                self.connection.executemany('INSERT OR IGNORE INTO found VALUES (?, ?, ?)',
+                                            [(search, video_id, found_at) for video_id, _ in ids])
+                self.connection.execute('INSERT INTO imported_checkpoints VALUES (?)', (str(pickle_path),))
+                self.connection.commit()
+
+    def window_end(self, search, default):
+        """
+        The end of the publish date windows of a search. It is saved on the search's first run and kept until
+        the search pages through all its slices (see finish_windows), so the slices and their cached pages stay
+        the same on every day the search resumes.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT published_before FROM search_windows WHERE search = ?',
+                                          (search,)).fetchone()
+            if row is not None:
+                return datetime.datetime.fromisoformat(row[0])
+            self.connection.execute('INSERT INTO search_windows VALUES (?, ?)',
+                                    (search, default.isoformat(timespec='seconds')))
+            self.connection.commit()
+        return default
+
+    def finish_windows(self, search):
+        """
+        Forget the window end of a search that paged through all its slices, so its next run includes the
+        videos that were uploaded since.
+        """
+        with self.lock:
+            self.connection.execute('DELETE FROM search_windows WHERE search = ?', (search,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+YOUTUBE_FIRST_UPLOAD = datetime.datetime(2005, 4, 23)
+
+
+def end_of_today():
+    return datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+
+
+def search_slices(search_term, query_variants=(), time_windows=1, published_after=None, published_before=None):
+    """
+    Split a search into slices: the search term and every query variant (e.g. synonyms), each in time_windows
+    equal periods between published_after (default: the first YouTube upload) and published_before
+    (default: the end of today, so the slices and their cached pages stay the same during the day;
+    iter_youtube_urls keeps it in the VideoIndex so they stay the same until the search finished).
+    Every slice gets its own few hundred results from YouTube, so the recall grows with the number of slices.
+
+    Returns the search().list params of every slice (q, and publishedAfter / publishedBefore).
+    """
+    queries = [search_term] + [variant for variant in query_variants if variant != search_term]
+    if time_windows <= 1 and published_after is None and published_before is None:
+        return [{'q': query} for query in queries]
+    start = published_after or YOUTUBE_FIRST_UPLOAD
+    end = published_before or end_of_today()
+    step = (end - start) / max(time_windows, 1)
+    windows = [(start + step * index, start + step * (index + 1)) for index in range(max(time_windows, 1))]
+    return [{'q': query,
+             'publishedAfter': after.strftime('%Y-%m-%dT%H:%M:%SZ'),
+             'publishedBefore': before.strftime('%Y-%m-%dT%H:%M:%SZ')}
+            for query in queries for after, before in windows]
+
+
+def slice_name(search_slice):
+    if 'publishedAfter' not in search_slice:
+        return search_slice['q']
+    return f'{search_slice["q"]} ({search_slice["publishedAfter"][:10]} - {search_slice["publishedBefore"][:10]})'
+
+
+def fetch_search_page(youtube_client, params, search_cache, quota_scheduler=None, quota_name=None):
+    """
+    Return a search result page from search_cache (a cached page costs no quota), or from the API and cache it.
+    youtube_client returns the API client of the calling thread.
+    Returns None if quota_scheduler doesn't allow quota_name another page today.
+    API errors that retrying didn't fix are raised, with their category (see RateLimiter).
+    """
+    res = search_cache.get(params)
+    if res is not None:
+        return res
+    if quota_scheduler is not None and not quota_scheduler.acquire(quota_name):
+        return None
+    request = youtube_client().search().list(**params)
+
+    def execute():
+        # Every attempt costs quota, also the ones that fail.
+        run_stats().count('quota_units', SEARCH_LIST_COST)
+        return request.execute()
+    with run_stats().timer('api_search_page'):
+        res = API_RATE_LIMITER.call(execute)
+    search_cache.put(params, res)
+    return res
+
+
+def iter_youtube_urls(database_path, search_term, must_have_in_title_or_description, must_not_have_in_title_or_description, pickle_exists_only_download=False, whole_words=False, search_cache=None, quota_scheduler=None, prescreen=None, query_variants=(), time_windows=1, slice_workers=4, video_index=None, casefold=False):
+    """
+    To make it work you need to create google (Youtube) API key.
+    Yields (url, title) of the YouTube videos that match the search term, page by page,
+    so the downloads can start while the search is still paging.
+
+    Every page is saved to video_index (a VideoIndex, by default 'video_index.sqlite' next to database_path)
+    before its urls are yielded, so nothing that was found is lost if the run dies.
+    The urls the search found earlier the same day are yielded first (only them if pickle_exists_only_download).
+    The title and description are filtered with KeywordFilter (whole_words and casefold are passed to it).
+    The raw result pages are read from / saved to search_cache (a SearchCache). By default the cache is
+    'youtube_search_cache' next to database_path, so it is shared by all the searches in the same folder.
+    If quota_scheduler (a QuotaScheduler) is given, every API call must be allowed by it under the name
+    search_key(database_path), and the search stops paging for today when its share of the quota is used.
+    The videos that pass the keywords are checked by prescreen (a MetadataPrescreen) before they are yielded.
+    By default it uses 'video_metadata.sqlite' next to database_path and its default limits (and is closed
+    when the generator finishes). The videos it couldn't check are saved and checked on the next run.
+    YouTube stops paging a search after a few hundred results, so the search can be split into slices
+    (see search_slices): the search term and every one of query_variants, in each of time_windows periods.
+    The pages of up to slice_workers slices are fetched at the same time, and a video that several slices
+    find is yielded once. The end of the time windows is kept in video_index until the search paged through
+    all of them, so a search that resumes on another day gets the same slices and replays its cached pages.
+
+    The generator returns True if the search paged through all the results.
+    """
+
+    # Set the API key and service name, Idan's key.
+    API_KEY = ''
+    own_video_index = video_index is None
+    if video_index is None:
+        video_index = VideoIndex(database_path.parent.joinpath('video_index.sqlite'))
+    own_prescreen = prescreen is None
+    try:
+        video_index.import_checkpoints(database_path.name, database_path, search_term)
+
+        # if the search already ran today, meaning the script failed earlier
+        # so it loads the videos it found so that it wont add the same urls again.
+        # Only the ids are kept in memory, the titles were already yielded.
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        found_today = video_index.found(database_path.name, since=today)
+        for video_id, title in found_today:
+            yield f'https://www.youtube.com/watch?v={video_id}', title
+        seen_ids = set(video_id for video_id, _ in found_today)
+        del found_today
+        if pickle_exists_only_download:
+            return
+
+        # First page of 50 videos (still not using it. first use in the while loop)
+        youtube = build('youtube', 'v3', developerKey=API_KEY)
+        keyword_filter = KeywordFilter(must_have_in_title_or_description, must_not_have_in_title_or_description,
+                                       whole_words=whole_words, casefold=casefold)
+        if search_cache is None:
+            search_cache = SearchCache(database_path.parent.joinpath('youtube_search_cache'))
+        if prescreen is None:
+            prescreen = MetadataPrescreen(database_path.parent.joinpath('video_metadata.sqlite'))
+
+        quota_name = search_key(database_path)
+
+        # The videos that couldn't be pre-screened on an earlier run are checked first.
+        deferred = prescreen.deferred_videos(quota_name)
+        if deferred:
+            accepted_ids, deferred_ids = prescreen.filter(youtube, list(deferred), quota_scheduler, quota_name)
+            accepted_ids = [video_id for video_id in accepted_ids if video_id not in seen_ids]
+            seen_ids.update(accepted_ids)
+            for video_id in accepted_ids:
+                yield f'https://www.youtube.com/watch?v={video_id}', deferred[video_id]
+            prescreen.undefer(quota_name, set(deferred) - set(deferred_ids))
+
+        # The http client of googleapiclient isn't thread safe, so every slice worker builds its own client.
+        clients = threading.local()
+
+        def youtube_client():
+            if not hasattr(clients, 'youtube'):
+                clients.youtube = build('youtube', 'v3', developerKey=API_KEY)
+            return clients.youtube
+
+        # The windows end where they ended on the search's first run, until it pages through all of them,
+        # otherwise every day would get new windows, new cache keys and pay the quota again.
+        published_before = video_index.window_end(database_path.name, end_of_today()) if time_windows > 1 else None
+        slices = search_slices(search_term, query_variants, time_windows, published_before=published_before)
+        # The next page token of every slice that has more pages.
+        next_pages = {index: 'default' for index in range(len(slices))}
+        limit_queries_reached = False
+        # The slices that stopped on the quota or an error that may pass, they resume within the same windows.
+        # A slice that failed permanently won't do better on another day, so it doesn't keep the windows.
+        unfinished_slices = set()
+        with ThreadPoolExecutor(max_workers=min(slice_workers, len(slices)), initializer=run_stats().bind) as pool:
+            while next_pages:
+                futures = dict()
+                for index, nextPageToken in next_pages.items():
+                    params = dict(slices[index], part='snippet',
+                                  type='video',
+                                  maxResults=50,
+                                  pageToken=nextPageToken)
+                    futures[index] = pool.submit(fetch_search_page, youtube_client, params, search_cache,
+                                                 quota_scheduler, quota_name)
+                # The pages are handled in the order of the slices, and all the fetched pages are handled
+                # even if a slice ran out of quota, they were paid for.
+                quota_used = False
+                for index, future in futures.items():
+                    try:
+                        res = future.result()
+                    # Meaning reached limit queries for today, or an error that retrying didn't fix.
+                    except Exception as e:
+                        # Only the errors of RateLimiter.call have a category,
+                        # e.g. a failed build() or cache write don't.
+                        category = getattr(e, 'category', None) or classify_error(e)
+                        print(f'{slice_name(slices[index])}: stopped paging because of a {category} error: {e}')
+                        run_stats().failure('api_search', e)
+                        limit_queries_reached = True
+                        quota_used = quota_used or category == 'quota'
+                        if category != 'permanent':
+                            unfinished_slices.add(index)
+                        del next_pages[index]
+                        continue
+                    if res is None:
+                        print(f'{slice_name(slices[index])}: used its share of the API quota for today')
+                        limit_queries_reached = True
+                        quota_used = True
+                        unfinished_slices.add(index)
+                        del next_pages[index]
+                        continue
+                    run_stats().count('search_pages')
+                    run_stats().count('search_results', len(res['items']))
+
+                    page_urls = dict()
+                    for video in res['items']:
+                        if not keyword_filter.matches(video['snippet']['title'], video['snippet']['description']):
+                            continue
+                        run_stats().count('keyword_matches')
+
+                        # if the filter passes, add the video URL and title to the page urls
+                        # (a video found by several slices is added once)
+                        video_id = video['id']['videoId']
+                        if video_id not in seen_ids:
+                            page_urls[f'https://www.youtube.com/watch?v={video_id}'] = video['snippet']['title']
+
+                    # One videos().list call checks the whole page before anything is downloaded.
+                    # The videos it can't check are deferred to the next run, they aren't downloaded unchecked.
+                    if page_urls:
+                        titles = {video_id_from_url(url): title for url, title in page_urls.items()}
+                        accepted_ids, deferred_ids = prescreen.filter(youtube, list(titles), quota_scheduler,
+                                                                      quota_name)
+                        if deferred_ids:
+                            prescreen.defer(quota_name, {video_id: titles[video_id] for video_id in deferred_ids})
+                        accepted_ids = set(accepted_ids)
+                        page_urls = {url: title for url, title in page_urls.items()
+                                     if video_id_from_url(url) in accepted_ids}
+
+                    # Save the page before handing out its urls. There is a limit for each day.
+                    # So if it found 600 files and then failed,
+                    # it will continue the next day.
+                    # The search is looking for different videos names.
+                    page_ids = [video_id_from_url(url) for url in page_urls]
+                    video_index.add_page(database_path.name, res['items'], page_ids)
+                    if page_urls:
+                        seen_ids.update(page_ids)
+                        yield from page_urls.items()
+
+                    if 'nextPageToken' in res:
+                        next_pages[index] = res['nextPageToken']
+                    else:
+                        del next_pages[index]
+                if quota_used:
+                    break
+
+        print(search_cache.report())
+        print(prescreen.report())
+        # Every slice either paged through or failed permanently (a break on the quota leaves pages behind).
+        if not next_pages and not unfinished_slices and published_before is not None:
+            video_index.finish_windows(database_path.name)
+        return not limit_queries_reached
+    finally:
+        if own_prescreen and prescreen is not None:
+            prescreen.close()
+        if own_video_index:
+            video_index.close()
+
+
+def get_youtube_urls(database_path, search_term, must_have_in_title_or_description, must_not_have_in_title_or_description, pickle_exists_only_download=False, whole_words=False, search_cache=None, prescreen=None, query_variants=(), time_windows=1, casefold=False):
+    """
+    To make it work you need to create google (Youtube) API key.
+    Returns a dict of YouTube urls (and their titles) that match the search term.
+    See iter_youtube_urls for a version that yields the urls while it is still paging.
+    """
+    return dict(iter_youtube_urls(database_path, search_term,
+                                  must_have_in_title_or_description,
+                                  must_not_have_in_title_or_description,
+                                  pickle_exists_only_download,
+                                  whole_words,
+                                  search_cache,
+                                  prescreen=prescreen,
+                                  query_variants=query_variants,
+                                  time_windows=time_windows,
+                                  casefold=casefold))
+
+
+def ffmpeg_audio_options(sample_rate=None, channels=None):
+    """
+    The ffmpeg output options that resample the audio and/or change its number of channels.
+    """
+    options = []
+    if sample_rate:
+        options += ['-ar', str(sample_rate)]
+    if channels:
+        options += ['-ac', str(channels)]
+    return options
+
+
+def extract_wav(media_path, ffmpeg_slots=None, keep_original=False, sample_rate=None, channels=None,
+                audio_format='wav'):
+    """
+    Convert a downloaded media file to wav with ffmpeg and delete the original file.
+
+    Parameters:
+    - media_path (Path): The file youtube_dl downloaded.
+    - ffmpeg_slots (threading.Semaphore, optional): Limits how many ffmpeg processes run at the same time.
+      If None, the conversion runs without waiting for a slot.
+    - keep_original (bool, optional): If True, the original file is not deleted (used when it is the video).
+    - sample_rate, channels (int, optional): Resample / remix the audio. Defaults to the original's.
+    - audio_format (str, optional): The extension of the output, ffmpeg picks the codec from it. Defaults to 'wav'.
+
+    Returns the path of the audio file.
+    """
+    wav_path = media_path.with_suffix(f'.{audio_format}')
+    command = (['ffmpeg', '-y', '-loglevel', 'error', '-i', str(media_path), '-vn']
+               + ffmpeg_audio_options(sample_rate, channels) + [str(wav_path)])
+    with ffmpeg_slots if ffmpeg_slots is not None else nullcontext():
+        with run_stats().timer('ffmpeg_transcode'):
+            subprocess.run(command, check=True)
+    if media_path != wav_path and not keep_original:
+        os.remove(media_path)
+    return wav_path
+
+
+def call_directly(function):
+    """
+    The default network_call of download_media: no rate limit and no retries.
+    """
+    return function()
+
+
+def download_format(info_dict, format_spec, outtmpl):
+    """
+    Download one format of a video whose info was already extracted, without fetching the video page again.
+
+    Parameters:
+    - info_dict (dict): The result of YoutubeDL.extract_info(url, download=False, process=False).
+    - format_spec (str): youtube_dl format selector, e.g. 'bestaudio/best' or 'worst'.
+    - outtmpl (str): youtube_dl output template.
+
+    Returns the path of the downloaded file.
+    """
+    with youtube_dl.YoutubeDL({'format': format_spec, 'outtmpl': outtmpl}) as ydl:
+        # process_ie_result adds the selected format to the dict, so every selection gets its own copy.
+        with run_stats().timer('download'):
+            result = ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+        file_path = Path(ydl.prepare_filename(result))
+    if file_path.exists():
+        run_stats().count('download_bytes', file_path.stat().st_size)
+    return file_path
+
+
+class AudioTranscoder:
+    """
+    How the audio of a video becomes the dataset's audio file: its format, sample rate and channels,
+    and whether the audio stream is downloaded first or piped straight into ffmpeg.
+
+    Without stream, youtube_dl downloads the audio format to disk and extract_wav converts it, so every video
+    is written twice. With stream, ffmpeg reads the selected audio format from its URL (with youtube_dl's
+    http headers) and writes the final file in one pass. Formats that only youtube_dl can download
+    (DASH/HLS manifests, merged formats) and streams that ffmpeg fails to read are downloaded as before.
+    The streaming ffmpeg doesn't wait for an ffmpeg slot: it is limited by the network, not the CPU,
+    and the number of downloads already limits it.
+
+    Parameters:
+    - stream (bool, optional): Pipe the audio stream into ffmpeg. Defaults to False.
+    - sample_rate (int, optional): The sample rate of the audio files, e.g. 16000. Defaults to the original's.
+    - channels (int, optional): The number of channels, e.g. 1 for mono. Defaults to the original's.
+    - audio_format (str, optional): 'wav' (default) or another extension ffmpeg can write, e.g. 'flac'.
+    """
+    STREAM_PROTOCOLS = ('http', 'https')
+    FORMAT_SPEC = 'bestaudio/best'
+
+    def __init__(self, stream=False, sample_rate=None, channels=None, audio_format='wav'):
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.audio_format = audio_format
+
+    def from_file(self, media_path, ffmpeg_slots=None, keep_original=False):
+        """
+        Convert a downloaded file (see extract_wav). Returns the path of the audio file.
+        """
+        return extract_wav(media_path, ffmpeg_slots, keep_original, self.sample_rate, self.channels, self.audio_format)
+
+    def audio(self, info_dict, outtmpl, ffmpeg_slots=None, network_call=call_directly):
+        """
+        Get the audio of a video whose info was already extracted. Returns the path of the audio file.
+        The download (or the streaming transcode) is made through network_call, see download_media.
+        """
+        if self.stream:
+            with youtube_dl.YoutubeDL({'format': self.FORMAT_SPEC, 'outtmpl': outtmpl}) as ydl:
+                selected = ydl.process_ie_result(copy.deepcopy(info_dict), download=False)
+                audio_path = Path(ydl.prepare_filename(dict(selected, ext=self.audio_format)))
+            if ('requested_formats' not in selected and selected.get('url')
+                    and selected.get('protocol', 'https') in self.STREAM_PROTOCOLS):
+                try:
+                    return network_call(lambda: self.from_stream(selected, audio_path))
+                except subprocess.CalledProcessError as e:
+                    print(f'streaming {info_dict.get("id")} failed ({e}), downloading it instead')
+                    if audio_path.exists():
+                        os.remove(audio_path)
+        return self.from_file(network_call(lambda: download_format(info_dict, self.FORMAT_SPEC, outtmpl)), ffmpeg_slots)
+
+    def from_stream(self, selected, audio_path):
+        """
+        Transcode the selected format from its URL into audio_path with one ffmpeg. Returns audio_path.
+        """
+        command = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        headers = selected.get('http_headers') or dict()
+        if headers:
+            command += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in headers.items())]
+        command += (['-i', selected['url'], '-vn'] + ffmpeg_audio_options(self.sample_rate, self.channels)
+                    + [str(audio_path)])
+        with run_stats().timer('stream_transcode'):
+            subprocess.run(command, check=True)
+        run_stats().count('streamed_videos')
+        return audio_path
+
+
+def download_media(outtmpl, url, audio=True, video=False, ffmpeg_slots=None, audio_from_video=False, postprocess=None,
+                   transcoder=None, network_call=call_directly):
+    """
+    Download the audio (as wav) and/or the video of a YouTube video.
+    The video page is fetched and its info extracted once, and the audio and video downloads both reuse it.
+
+    Parameters:
+    - outtmpl (str): youtube_dl output template of the downloaded files.
+    - url (str): The URL of the YouTube video.
+    - audio (bool, optional): Download the audio and convert it to wav. Defaults to True.
+    - video (bool, optional): Download the video. Defaults to False.
+    - ffmpeg_slots (threading.Semaphore, optional): Shared limit on concurrent ffmpeg conversions.
+    - audio_from_video (bool, optional): When both are downloaded, download only the video and extract the wav
+      from it instead of downloading a separate audio stream.
+    - postprocess (callable, optional): Applied to the wav path after the download (e.g. SilenceTrimmer),
+      it returns the path of the processed file.
+    - transcoder (AudioTranscoder, optional): The format, sample rate and channels of the audio, and whether
+      it is streamed into ffmpeg. Defaults to downloading and converting to wav.
+    - network_call (callable, optional): Makes the network calls (the info extraction and the downloads),
+      network_call(function) returns function(). download_with_retry passes one that rate limits and retries them,
+      so the ffmpeg conversions and the trimming are neither throttled nor retried. Defaults to call_directly.
+
+    Returns the info dict of the video and a dict of the downloaded paths by kind ('audio', 'video').
+    """
+    transcoder = transcoder or AudioTranscoder()
+    with youtube_dl.YoutubeDL({'outtmpl': outtmpl}) as ydl:
+        with run_stats().timer('extract_info'):
+            info_dict = network_call(lambda: ydl.extract_info(url, download=False, process=False))
+
+    paths = dict()
+    if audio and video and audio_from_video:
+        paths['video'] = network_call(lambda: download_format(info_dict, 'worst', outtmpl))
+        paths['audio'] = transcoder.from_file(paths['video'], ffmpeg_slots, keep_original=True)
+    else:
+        # The wav conversion is done by extract_wav and not by youtube_dl's FFmpegExtractAudio
+        # so the number of ffmpeg processes can be limited separately from the number of downloads.
+        if audio:
+            paths['audio'] = transcoder.audio(info_dict, outtmpl, ffmpeg_slots, network_call)
+        if video:
+            paths['video'] = network_call(lambda: download_format(info_dict, 'worst', outtmpl))
+    if postprocess is not None and 'audio' in paths:
+        paths['audio'] = postprocess(paths['audio'])
+    return info_dict, paths
+
+
+def video_id_from_url(url):
+    """
+    Return the video id of a https://www.youtube.com/watch?v=... url.
+    """
+    return parse_qs(urlparse(url).query)['v'][0]
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as media_file:
+        for chunk in iter(lambda: media_file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class MediaStore:
+    """
+    A media store shared by all the searches, so a video is downloaded and converted at most once.
+
+    The files are saved once under objects/, named by the sha256 of their content, and an index
+    (media_store.sqlite) maps every (video id, kind) to its object. The search folders get hardlinks
+    to the objects named '{title} [{video id}].{ext}', so titles can't collide and a video found by
+    several searches takes its disk space once.
+
+    Parameters:
+    - root (Path): The directory of the store. It must be on the same disk as the search folders for hardlinks.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root.joinpath('objects'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.video_locks = dict()
+        self.connection = sqlite3.connect(str(root.joinpath('media_store.sqlite')), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS media (video_id TEXT, kind TEXT, sha256 TEXT, ext TEXT, '
+                                'size INTEGER, title TEXT, stored_at TEXT, PRIMARY KEY (video_id, kind))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, video_id TEXT, kind TEXT)')
+        self.connection.commit()
+
+    @contextmanager
+    def video_lock(self, video_id):
+        """
+        Hold the lock of one video id, so two searches that find the same video don't download it at the same time.
+        The lock is dropped when no thread holds or waits for it, so video_locks doesn't grow with every video.
+        """
+        with self.lock:
+            lock, users = self.video_locks.get(video_id, (None, 0))
+            lock = lock or threading.Lock()
+            self.video_locks[video_id] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                users = self.video_locks[video_id][1] - 1
+                if users:
+                    self.video_locks[video_id] = (lock, users)
+                else:
+                    del self.video_locks[video_id]
+
+    def get(self, video_id, kind):
+        """
+        Return (object path, title) of the stored video id and kind, or None if it isn't stored.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT sha256, ext, title FROM media WHERE video_id = ? AND kind = ?',
+                                          (video_id, kind)).fetchone()
+        if row is None:
+            return None
+        sha256, ext, title = row
+        object_path = self.object_path(sha256, ext)
+        return (object_path, title) if object_path.exists() else None
+
+    def object_path(self, sha256, ext):
+        return self.root.joinpath('objects', sha256[:2], f'{sha256}.{ext}')
+
+    def add(self, video_id, kind, file_path, title):
+        """
+        Move a downloaded file into the store and index it. Returns the object path.
+        """
+        sha256 = file_sha256(file_path)
+        ext = file_path.suffix.lstrip('.')
+        object_path = self.object_path(sha256, ext)
+        os.makedirs(object_path.parent, exist_ok=True)
+        if object_path.exists():
+            os.remove(file_path)
+        else:
+            os.replace(file_path, object_path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (video_id, kind, sha256, ext, object_path.stat().st_size, title,
+                                     datetime.datetime.now().isoformat()))
+            self.connection.commit()
+        return object_path
+
+    def link(self, video_id, kind, database_path):
+        """
+        Hardlink the stored file into a search folder (a symlink if the folder is on another disk).
+        A file that is already there but isn't the stored object (e.g. a stale copy) is replaced.
+        Returns the path in the search folder.
+        """
+        object_path, title = self.get(video_id, kind)
+        link_path = database_path.joinpath(
+            youtube_dl.utils.sanitize_filename(f'{title} [{video_id}]') + object_path.suffix)
+        if not self.links_to(link_path, object_path):
+            # Linked under a temp name and renamed, so the search folder never lacks the file.
+            temp_path = link_path.with_name(f'.{uuid.uuid4().hex}.tmp')
+            try:
+                os.link(object_path, temp_path)
+            except OSError:
+                os.symlink(object_path, temp_path)
+            os.replace(temp_path, link_path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?)', (str(link_path), video_id, kind))
+            self.connection.commit()
+        return link_path
+
+    @staticmethod
+    def links_to(link_path, object_path):
+        try:
+            return os.path.samefile(link_path, object_path)
+        except OSError:
+            # No file, or a broken symlink.
+            return False
+
+    def release(self, link_path):
+        """
+        Delete a file of a search folder, and its stored object too when no other search folder links to it.
+        The index keeps the video, so it is downloaded again only if another search needs it later.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT video_id, kind FROM links WHERE path = ?',
+                                          (str(link_path),)).fetchone()
+            self.connection.execute('DELETE FROM links WHERE path = ?', (str(link_path),))
+            self.connection.commit()
+        if link_path.exists() or link_path.is_symlink():
+            os.remove(link_path)
+        if row is None:
+            return
+        with self.lock:
+            other_links = self.connection.execute('SELECT COUNT(*) FROM links WHERE video_id = ? AND kind = ?',
+                                                  row).fetchone()[0]
+        stored = self.get(*row)
+        if not other_links and stored is not None:
+            os.remove(stored[0])
+
+    def fetch(self, database_path, url, with_video=False, ffmpeg_slots=None, audio_from_video=False, postprocess=None,
+              transcoder=None, network_call=call_directly):
+        """
+        Download the kinds of the video that aren't stored yet and link all of them into database_path.
+        postprocess and transcoder are applied to a new audio file before it is stored, so they run once per video
+        too: a video that is already stored keeps the audio format it was stored with.
+        Returns the paths in database_path.
+        """
+        video_id = video_id_from_url(url)
+        kinds = ['audio', 'video'] if with_video else ['audio']
+        with self.video_lock(video_id):
+            missing = [kind for kind in kinds if self.get(video_id, kind) is None]
+            if missing:
+                incoming_path = self.root.joinpath('incoming', video_id)
+                os.makedirs(incoming_path, exist_ok=True)
+                try:
+                    info_dict, paths = download_media(str(incoming_path.joinpath('%(id)s.%(ext)s')), url,
+                                                      audio='audio' in missing, video='video' in missing,
+                                                      ffmpeg_slots=ffmpeg_slots, audio_from_video=audio_from_video,
+                                                      postprocess=postprocess, transcoder=transcoder,
+                                                      network_call=network_call)
+                    for kind, file_path in paths.items():
+                        self.add(video_id, kind, file_path, info_dict.get('title', video_id))
+                finally:
+                    shutil.rmtree(incoming_path, ignore_errors=True)
+            else:
+                print(f'{url} is already in the media store')
+            return [self.link(video_id, kind, database_path) for kind in kinds]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def downloaded_from_youtube(database_path, url, with_video=False, ffmpeg_slots=None, audio_from_video=False,
+                            media_store=None, postprocess=None, transcoder=None, network_call=call_directly):
     """
     Download audio/video from a YouTube video and save it to the specified database path.
 
@@ -109,89 +1673,475 @@ def downloaded_from_youtube(database_path, url, with_video=False):
     - url (str): The URL of the YouTube video to download audio from.
     - with_video (bool, optional): Whether to download both audio and video. If True, the audio will be extracted
       from the video. If False (default), only the audio will be downloaded.
+    - ffmpeg_slots (threading.Semaphore, optional): Shared limit on concurrent ffmpeg conversions.
+    - audio_from_video (bool, optional): With with_video, download only the video and extract the wav from it
+      instead of downloading a separate audio stream. Cheaper, but the audio quality is the video's.
+    - media_store (MediaStore, optional): If given, the files are downloaded into the store (only if it doesn't
+      have them yet) and hardlinked into database_path. Otherwise they are saved as '{title}.{ext}'.
+    - postprocess (callable, optional): Applied to the downloaded wav, e.g. a SilenceTrimmer.
+    - transcoder (AudioTranscoder, optional): The audio format and whether the audio is streamed into ffmpeg.
+    - network_call (callable, optional): Makes the network calls, see download_media.
+
+    Returns the paths of the files in database_path.
     """
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': str(database_path.joinpath('%(title)s.%(ext)s')),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'wav',
-        }],
-    }
+    if media_store is not None:
+        return media_store.fetch(database_path, url, with_video, ffmpeg_slots, audio_from_video, postprocess,
+                                 transcoder, network_call)
+    _, paths = download_media(str(database_path.joinpath('%(title)s.%(ext)s')), url, audio=True, video=with_video,
+                              ffmpeg_slots=ffmpeg_slots, audio_from_video=audio_from_video, postprocess=postprocess,
+                              transcoder=transcoder, network_call=network_call)
+    return list(paths.values())
+
+
+def download_with_retry(database_path, url, with_video=False, ffmpeg_slots=None, retries=3, backoff_seconds=5,
+                        audio_from_video=False, media_store=None, postprocess=None, rate_limiter=None,
+                        transcoder=None):
+    """
+    Call downloaded_from_youtube with its network calls (the info extraction and the downloads) made through
+    a RateLimiter, which retries them with jittered exponential backoff if they fail with a transient error
+    (throttling, server or network errors). A failed ffmpeg conversion or trim isn't retried and doesn't slow
+    the downloads down, and a retry doesn't download the files that were already downloaded.
 
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    Parameters:
+    - database_path (Path): The directory where the downloaded files will be saved.
+    - url (str): The URL of the YouTube video.
+    - with_video (bool, optional): Whether to download the video as well.
+    - ffmpeg_slots (threading.Semaphore, optional): Shared limit on concurrent ffmpeg conversions.
+    - retries (int, optional): How many times to retry after the first failure.
+    - backoff_seconds (float, optional): The longest wait before the first retry. It doubles on every retry.
+    - audio_from_video (bool, optional): See downloaded_from_youtube.
+    - media_store (MediaStore, optional): See downloaded_from_youtube.
+    - postprocess (callable, optional): See downloaded_from_youtube.
+    - rate_limiter (RateLimiter, optional): Defaults to DOWNLOAD_RATE_LIMITER, shared by all the download workers.
+    - transcoder (AudioTranscoder, optional): See downloaded_from_youtube.
+
+    Returns the paths of the files in database_path. Raises the last error if all the attempts failed,
+    or at once if the error is permanent (e.g. the video is private).
+    """
+    rate_limiter = rate_limiter or DOWNLOAD_RATE_LIMITER
+
+    def network_call(function):
+        return rate_limiter.call(function, retries=retries, base_delay=backoff_seconds)
+    return downloaded_from_youtube(database_path, url, with_video, ffmpeg_slots, audio_from_video, media_store,
+                                   postprocess, transcoder, network_call)
+
+
+def frame_levels_db(audio_file, frame_size=2048, block_frames=256):
+    """
+    Read an open soundfile.SoundFile block by block and return the RMS level (dB) of every frame,
+    so the whole signal is never in memory, only one float per frame.
+    """
+    levels = []
+    for block in audio_file.blocks(blocksize=frame_size * block_frames, dtype='float32', always_2d=True):
+        mono = block.mean(axis=1)
+        n_frames = -(-len(mono) // frame_size)
+        mono = np.pad(mono, (0, n_frames * frame_size - len(mono)))
+        rms = np.sqrt((mono.reshape(n_frames, frame_size) ** 2).mean(axis=1))
+        levels.append(20 * np.log10(np.maximum(rms, 1e-10)))
+    return np.concatenate(levels) if levels else np.zeros(0)
 
-    if with_video:
-        ydl_opts = {
-            'format': 'worst',
-            'outtmpl': str(database_path.joinpath('%(title)s.%(ext)s')),
-            'preferredcodec': 'mp4'
 
-        }
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+def trim_silence(wav_path, top_db=60, output_format='flac', frame_size=2048, block_frames=256):
+    """
+    Trim leading and trailing silence from an audio file and write it as 16 bit FLAC or wav.
 
+    It streams the file twice: the first pass finds the frames that are quieter than the loudest frame
+    by more than top_db, the second copies the samples between the first and last loud frames to the output.
+    The input file is deleted when the output has a different name.
+
+    Parameters:
+    - wav_path (Path): The downloaded wav file.
+    - top_db (float, optional): Frames quieter than the loudest frame by more than that are silence. Defaults to 60.
+    - output_format (str, optional): 'flac' (default) or 'wav'. Both are written as 16 bit PCM.
+    - frame_size (int, optional): The frame length of the silence detector in samples. Defaults to 2048.
+    - block_frames (int, optional): How many frames are read at a time. Defaults to 256.
 
-def upload_file_to_sharepoint(file_path, search_term):
+    Returns the path of the output file (wav_path itself if the file is all silence).
     """
-    *** NOT WORKING YET ***
-    Upload file to s SharePoint server.
-    To make it work you need your sharepoint_user and sharepoint_password.
+    with sf.SoundFile(str(wav_path)) as audio_file:
+        sample_rate, channels, length = audio_file.samplerate, audio_file.channels, audio_file.frames
+        levels = frame_levels_db(audio_file, frame_size, block_frames)
+    if not len(levels) or levels.max() <= -200:
+        return wav_path
+    loud_frames = np.flatnonzero(levels > levels.max() - top_db)
+    start, end = loud_frames[0] * frame_size, min((loud_frames[-1] + 1) * frame_size, length)
+
+    output_path = wav_path.with_suffix('.' + output_format)
+    temp_path = output_path.with_name(output_path.stem + '.trimming.' + output_format)
+    with sf.SoundFile(str(wav_path)) as audio_file, \
+            sf.SoundFile(str(temp_path), 'w', sample_rate, channels, subtype='PCM_16',
+                         format=output_format.upper()) as output_file:
+        audio_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            # Read as float and let the PCM_16 writer convert: libsndfile doesn't scale float files read as int16,
+            # so a float wav would come out as all zeros.
+            block = audio_file.read(min(frame_size * block_frames, remaining), dtype='float32', always_2d=True)
+            if not len(block):
+                break
+            output_file.write(block)
+            remaining -= len(block)
+    os.replace(temp_path, output_path)
+    if output_path != wav_path:
+        os.remove(wav_path)
+    return output_path
+
+
+class SilenceTrimmer:
     """
-    # SharePoint URL
-    url = 'https://wavesaudio.sharepoint.com/teams/Waves - AudioData'
+    Post-download stage that runs trim_silence in a process pool, so trimming runs on other cores
+    alongside the downloads. The download thread that calls it waits for its own file only.
 
-    # SharePoint folder URL
-    general_folder_url = url + '/Shared%20Documents/Sample%20Surfer/Instrument%20Classifier/To%20Sort%20From%20Youtube'
-    specific_folder_url = general_folder_url + '/' + search_term.replace(' ', '%20') + '%20' + 'Search'
-    # Create an authentication context
-    context = AuthenticationContext(url)
+    Parameters:
+    - pool (ProcessPoolExecutor): The pool the trimming runs in.
+    - top_db (float, optional): See trim_silence.
+    - output_format (str, optional): 'flac' (default) or 'wav'.
+    """
 
-    # Authenticate with SharePoint
-    sharepoint_user = '*****@waves.com'
-    sharepoint_password = '???????'
-    context.acquire_token_for_user(sharepoint_user, sharepoint_password)
+    def __init__(self, pool, top_db=60, output_format='flac'):
+        self.pool = pool
+        self.top_db = top_db
+        self.output_format = output_format
 
-    # Create a client context
-    client = ClientContext(url, context)
+    def __call__(self, wav_path):
+        with run_stats().timer('trim'):
+            return self.pool.submit(trim_silence, wav_path, self.top_db, self.output_format).result()
 
-    try:
-        # Check if the folder exists
-        client.web.get_folder_by_server_relative_url(specific_folder_url).execute_query()
-        print("Folder already exists")
-    except:
-        # Create the folder if it does not exist
-        new_folder = Folder()
-        new_folder.name = search_term + ' ' +'Search'
-        client.web.folders.add(general_folder_url, new_folder).execute_query()
-        print("Folder created")
 
-    # Open the local file
-    file_contents = open(file_path, "rb").read()
+# The SharePoint site and the folder (relative to the site) that the searches are uploaded to.
+SHAREPOINT_SITE_URL = 'https://wavesaudio.sharepoint.com/teams/Waves - AudioData'
+SHAREPOINT_FOLDER = 'Shared Documents/Sample Surfer/Instrument Classifier/To Sort From Youtube'
+
+
+def sharepoint_password_token(site_url, tenant, client_id, username, password):
+    """
+    A token function for SharePointUploader that signs in with a user name and password through MSAL.
+    The app registration of client_id must allow public client flows. MSAL caches the token and refreshes it
+    when it expires, so the password is sent once per run.
+    """
+    import msal
+    site = urlparse(site_url)
+    scopes = [f'{site.scheme}://{site.netloc}/.default']
+    app = msal.PublicClientApplication(client_id, authority=f'https://login.microsoftonline.com/{tenant}')
+
+    def token():
+        accounts = app.get_accounts(username=username)
+        result = app.acquire_token_silent(scopes, account=accounts[0]) if accounts else None
+        result = result or app.acquire_token_by_username_password(username, password, scopes=scopes)
+        # MSAL returns its errors (wrong password, MFA required, ...) instead of raising them.
+        if 'access_token' not in result:
+            raise PermissionError(f'SharePoint sign in of {username} failed: '
+                                  f'{result.get("error_description") or result.get("error")}')
+        return result
+    return token
+
+
+class SharePointUploader:
+    """
+    Upload files to a SharePoint folder.
+
+    It authenticates once: every upload thread gets its own ClientContext, and they all get their access token
+    from the same token function.
+    The folders that exist are remembered for the run, so a folder is checked (or created) once.
+    Files bigger than chunk_size are uploaded with an upload session, reading one chunk at a time from the disk.
+    The session and the uploaded offset are saved in state_path after every chunk, so a failed upload
+    continues from its last chunk the next time instead of starting over.
+
+    Parameters:
+    - site_url (str, optional): The SharePoint site. Point it to a local mock of the REST endpoints for testing.
+    - username (str, optional): Defaults to the SHAREPOINT_USER environment variable.
+    - password (str, optional): Defaults to the SHAREPOINT_PASSWORD environment variable.
+    - tenant (str, optional): The Azure AD tenant of the site. Defaults to the SHAREPOINT_TENANT environment variable.
+    - client_id (str, optional): The app registration used to sign in. Defaults to SHAREPOINT_CLIENT_ID.
+    - token_func (callable, optional): Returns an OAuth token response (a dict with access_token and token_type),
+      instead of signing in with username/password (see sharepoint_password_token).
+    - chunk_size (int, optional): The size of an upload chunk. Defaults to 10 MB.
+    - max_workers (int, optional): How many files upload_many uploads at the same time. Defaults to 4.
+    - state_path (Path, optional): The json file of the unfinished upload sessions. Without it uploads don't resume.
+    """
+
+    def __init__(self, site_url=SHAREPOINT_SITE_URL, username=None, password=None, tenant=None, client_id=None,
+                 token_func=None, chunk_size=10 * 1024 * 1024, max_workers=4, state_path=None):
+        self.site_url = site_url
+        self.site_path = urlparse(site_url).path.rstrip('/')
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.state_path = state_path
+        if token_func is None:
+            token_func = sharepoint_password_token(site_url,
+                                                   tenant or os.environ.get('SHAREPOINT_TENANT'),
+                                                   client_id or os.environ.get('SHAREPOINT_CLIENT_ID'),
+                                                   username or os.environ.get('SHAREPOINT_USER'),
+                                                   password or os.environ.get('SHAREPOINT_PASSWORD'))
+        self.token_func = token_func
+        self.local = threading.local()
+        self.known_folders = set()
+        self.folders_lock = threading.Lock()
+        self.sessions_lock = threading.Lock()
+        self.sessions = dict()
+        if state_path is not None and state_path.exists():
+            with open(state_path, encoding='utf-8') as state_file:
+                self.sessions = json.load(state_file)
+
+    def client(self):
+        """
+        The ClientContext of the calling thread (a ClientContext queues its requests, so threads can't share one).
+        """
+        if not hasattr(self.local, 'client'):
+            from office365.sharepoint.client_context import ClientContext
+            self.local.client = ClientContext(self.site_url).with_access_token(self.token_func)
+        return self.local.client
+
+    def server_relative_url(self, folder):
+        return f'{self.site_path}/{folder}'
+
+    def ensure_folder(self, folder):
+        """
+        Create the folder (relative to the site) if it doesn't exist. Checked once per run.
+        """
+        with self.folders_lock:
+            if folder in self.known_folders:
+                return
+            client = self.client()
+            folder_url = self.server_relative_url(folder)
+            from office365.runtime.client_request_exception import ClientRequestException
+            try:
+                client.web.get_folder_by_server_relative_url(folder_url).get().execute_query()
+            except ClientRequestException as e:
+                # Only a missing folder is created, other errors (e.g. authentication) are raised.
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                client.web.folders.add(folder_url).execute_query()
+                print(f'Folder {folder} created')
+            self.known_folders.add(folder)
+
+    def save_session(self, key, session):
+        with self.sessions_lock:
+            if session is None:
+                self.sessions.pop(key, None)
+            else:
+                self.sessions[key] = session
+            if self.state_path is not None:
+                temp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+                with open(temp_path, 'w', encoding='utf-8') as state_file:
+                    json.dump(self.sessions, state_file)
+                os.replace(temp_path, self.state_path)
+
+    def upload(self, file_path, folder):
+        """
+        Upload one file into the folder (relative to the site). Returns the server relative url of the file.
+        """
+        self.ensure_folder(folder)
+        client = self.client()
+        target_folder = client.web.get_folder_by_server_relative_url(self.server_relative_url(folder))
+        size = file_path.stat().st_size
+        if size <= self.chunk_size:
+            with open(file_path, 'rb') as content_file:
+                target_folder.upload_file(file_path.name, content_file.read())
+            client.execute_query()
+        else:
+            self.upload_chunked(client, target_folder, file_path, folder, size)
+        return f'{self.server_relative_url(folder)}/{file_path.name}'
+
+    def upload_chunked(self, client, target_folder, file_path, folder, size):
+        from office365.runtime.client_request_exception import ClientRequestException
+        key = str(file_path.resolve())
+        stat = file_path.stat()
+        session = self.sessions.get(key)
+        if session and (session['size'], session['mtime'], session['folder']) == (size, stat.st_mtime, folder):
+            try:
+                sp_file = client.web.get_file_by_server_relative_url(
+                    f'{self.server_relative_url(folder)}/{file_path.name}')
+                return self.upload_chunks(client, sp_file, file_path, key, session)
+            except ClientRequestException as e:
+                # The session may have expired on the server, start over.
+                print(f'Couldn\'t resume the upload of {file_path.name} ({e}), starting over')
+        session = {'upload_id': str(uuid.uuid4()), 'offset': 0, 'size': size, 'mtime': stat.st_mtime, 'folder': folder}
+        sp_file = target_folder.files.add(file_path.name, None, True)
+        client.execute_query()
+        self.upload_chunks(client, sp_file, file_path, key, session)
+
+    def upload_chunks(self, client, sp_file, file_path, key, session):
+        with open(file_path, 'rb') as content_file:
+            content_file.seek(session['offset'])
+            while session['offset'] < session['size']:
+                chunk = content_file.read(self.chunk_size)
+                if session['offset'] == 0:
+                    sp_file.start_upload(session['upload_id'], chunk)
+                elif session['offset'] + len(chunk) >= session['size']:
+                    sp_file.finish_upload(session['upload_id'], session['offset'], chunk)
+                else:
+                    sp_file.continue_upload(session['upload_id'], session['offset'], chunk)
+                client.execute_query()
+                session['offset'] += len(chunk)
+                self.save_session(key, session if session['offset'] < session['size'] else None)
+
+    def upload_many(self, file_paths, folder):
+        """
+        Upload many files into the folder, max_workers at a time.
+        Returns a dict of the files that failed and their errors.
+        """
+        errors = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers, initializer=run_stats().bind) as pool:
+            futures = {pool.submit(self.upload, file_path, folder): file_path for file_path in file_paths}
+            for future in futures:
+                try:
+                    future.result()
+                    print(f'Uploaded {futures[future].name}')
+                except Exception as e:
+                    print(f'Couldn\'t upload {futures[future].name}: {e}')
+                    errors[futures[future]] = e
+        return errors
+
+
+def sharepoint_search_folder(search_term):
+    """
+    The SharePoint folder (relative to the site) of a search.
+    """
+    return f'{SHAREPOINT_FOLDER}/{search_term} Search'
 
-    target_folder = client.web.get_folder_by_server_relative_url(specific_folder_url)
 
-    with open(file_path, 'rb') as content_file:
-        file_content = content_file.read()
-        target_folder.upload_file(file_path, file_content).execute_query()
+def upload_file_to_sharepoint(file_path, search_term, uploader=None):
+    """
+    Upload file to the SharePoint folder of the search.
+    To make it work you need your sharepoint user and password in the SHAREPOINT_USER and SHAREPOINT_PASSWORD
+    environment variables (and SHAREPOINT_TENANT / SHAREPOINT_CLIENT_ID), or an authenticated SharePointUploader.
+    """
+    if uploader is None:
+        uploader = SharePointUploader()
+    return uploader.upload(Path(file_path), sharepoint_search_folder(search_term))
 
-    # # Create a new file on SharePoint
-    # sp_file = File.create_with_binary(client, file_contents, specific_folder_url, file_path)
-    #
-    # # Execute the request
-    # client.execute_query()
 
+class DownloadLedger:
+    """
+    Keeps track of the downloaded videos of one search in a SQLite file (scanned_files.sqlite).
 
-def scrape_audio(database_path, search_term, must_have_in_title, must_not_have_in_title_or_description, with_video=False):
+    Every completed download is a single committed INSERT, so a crash can't leave a half written ledger,
+    and the scanned urls are kept in a set so "already scanned?" is an O(1) check.
+    The ledger can still be exported to the scanned_files.csv format for reading it by hand.
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.path = database_path.joinpath('scanned_files.sqlite')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scanned_files '
+                                '(url TEXT PRIMARY KEY, video_name TEXT, scanned_at TEXT, files TEXT, uploaded_at TEXT)')
+        # Ledgers from before the upload stage don't have the files and uploaded_at columns.
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(scanned_files)')]
+        for column in ('files', 'uploaded_at'):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE scanned_files ADD COLUMN {column} TEXT')
+        self.connection.commit()
+        self.urls = set(row[0] for row in self.connection.execute('SELECT url FROM scanned_files'))
+        # Searches that were scanned before the ledger existed only have scanned_files.csv.
+        if not self.urls:
+            self.import_csv(database_path.joinpath('scanned_files.csv'))
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add(self, url, video_name, files=None):
+        """
+        Record a completed download and its local files. Recording the same url twice keeps the first record.
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO scanned_files (url, video_name, scanned_at, files) '
+                                    'VALUES (?, ?, ?, ?)',
+                                    (url, video_name, datetime.datetime.now().isoformat(),
+                                     json.dumps([str(file) for file in files]) if files else None))
+            self.connection.commit()
+            self.urls.add(url)
+
+    def mark_uploaded(self, url):
+        """
+        Record that the files of the url were uploaded, after which they may be deleted locally.
+        """
+        with self.lock:
+            self.connection.execute('UPDATE scanned_files SET uploaded_at = ? WHERE url = ?',
+                                    (datetime.datetime.now().isoformat(), url))
+            self.connection.commit()
+
+    def forget(self, url):
+        """
+        Remove the record of a download, e.g. when its files are gone, so it is downloaded again.
+        """
+        with self.lock:
+            self.connection.execute('DELETE FROM scanned_files WHERE url = ?', (url,))
+            self.connection.commit()
+            self.urls.discard(url)
+
+    def pending_uploads(self):
+        """
+        Return (url, video name, files) of the downloads whose upload wasn't confirmed.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT url, video_name, files FROM scanned_files '
+                                           'WHERE uploaded_at IS NULL AND files IS NOT NULL').fetchall()
+        return [(url, video_name, [Path(file) for file in json.loads(files)]) for url, video_name, files in rows]
+
+    def entries(self):
+        """
+        Return (url, video name, scanned at, uploaded at) of all the downloads, in the order they were recorded.
+        """
+        with self.lock:
+            return self.connection.execute('SELECT url, video_name, scanned_at, uploaded_at FROM scanned_files '
+                                           'ORDER BY rowid').fetchall()
+
+    def import_csv(self, csv_path):
+        """
+        Load the rows of an existing scanned_files.csv (columns 'url' and 'video name') into the ledger.
+        """
+        if not csv_path.exists():
+            return
+        with open(csv_path, newline='', encoding='utf-8') as csv_file:
+            rows = [(row['url'], row['video name'], None) for row in csv.DictReader(csv_file)]
+        with self.lock:
+            self.connection.executemany('INSERT OR IGNORE INTO scanned_files (url, video_name, scanned_at) '
+                                        'VALUES (?, ?, ?)', rows)
+            self.connection.commit()
+            self.urls.update(row[0] for row in rows)
+
+    def export_csv(self, csv_path=None):
+        """
+        Write the ledger to scanned_files.csv (or to csv_path).
+        The file is written next to the target and then renamed, so readers never see a partial file.
+        """
+        csv_path = csv_path or self.database_path.joinpath('scanned_files.csv')
+        temp_path = csv_path.with_name(csv_path.name + '.tmp')
+        with self.lock:
+            rows = self.connection.execute('SELECT url, video_name FROM scanned_files ORDER BY rowid').fetchall()
+        with open(temp_path, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['url', 'video name'])
+            writer.writerows(rows)
+        os.replace(temp_path, csv_path)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def scrape_audio(database_path, search_term, must_have_in_title, must_not_have_in_title_or_description, with_video=False,
+                 max_downloads=4, max_ffmpeg_jobs=2, retries=3, audio_from_video=False, whole_words=False,
+                 media_store=None, trim=True, trim_format='flac', trim_workers=2, prescreen=None, uploader=None,
+                 pipeline_depth=None, report_formats=('json',), query_variants=(), time_windows=1, transcoder=None,
+                 casefold=False, stats=None):
     """
     Scrape audio files from YouTube based on search criteria and store information in a database.
 
     This function performs the following steps:
     1. Creates a directory at the specified 'database_path' if it doesn't exist.
-    2. Retrieves YouTube video URLs based on search criteria.
-    3. Creates or updates a 'scanned_files.csv' file to keep track of downloaded files.
-    4. Downloads audio files from YouTube.
+    2. Retrieves YouTube video URLs based on search criteria, page by page.
+    3. Opens the download ledger (scanned_files.sqlite) that keeps track of downloaded files.
+    4. Downloads audio files from YouTube with a pool of download workers while the search is still paging.
+    5. If an uploader is given, uploads them to the search's SharePoint folder and deletes them locally.
+    6. Exports the ledger to 'scanned_files.csv' and saves the run report ('run_report.json').
     
     Parameters:
     - database_path (pathlib.Path): The path to the directory where audio files and metadata will be stored.
@@ -199,145 +2149,1268 @@ def scrape_audio(database_path, search_term, must_have_in_title, must_not_have_i
     - must_have_in_title (str): A string that must be present in the video title or description.
     - must_not_have_in_title_or_description (str): A string that must not be present in the video title or description.
     - with_video (bool, optional): If True, download video along with audio. Defaults to False.
+    - max_downloads (int, optional): How many videos are downloaded at the same time. Defaults to 4.
+    - max_ffmpeg_jobs (int, optional): How many ffmpeg conversions run at the same time. Defaults to 2.
+    - retries (int, optional): How many times a failed download is retried. Defaults to 3.
+    - audio_from_video (bool, optional): With with_video, extract the wav from the downloaded video instead of
+      downloading a separate audio stream. Defaults to False.
+    - whole_words (bool, optional): Match the title/description keywords only as whole words. Defaults to False.
+    - casefold (bool, optional): Unescape html and casefold the title/description before matching the keywords,
+      instead of only lowercasing them. Defaults to False.
+    - query_variants (list of str, optional): More queries of the same search (e.g. synonyms), searched as well.
+    - time_windows (int, optional): Search every query in this many publish date windows. YouTube stops paging
+      a query after a few hundred results, so more queries/windows find more videos (and use more quota).
+      Defaults to 1.
+    - media_store (MediaStore, optional): The store the files are downloaded into and hardlinked from.
+      Defaults to 'media_store' next to database_path, which is shared by all the searches in the same folder.
+    - trim (bool, optional): Trim leading and trailing silence of every downloaded audio. Defaults to True.
+    - trim_format (str, optional): The format of the trimmed audio, 'flac' (default) or 'wav' (16 bit).
+    - trim_workers (int, optional): How many processes trim at the same time. Defaults to 2.
+    - prescreen (MetadataPrescreen, optional): The duration/definition/live limits that are checked before
+      downloading. Defaults to MetadataPrescreen's defaults (up to 30 minutes, no live streams).
+    - uploader (SharePointUploader, optional): Upload every downloaded video to SharePoint and delete it locally
+      once the upload is recorded in the ledger. Defaults to None (the files stay in database_path).
+    - pipeline_depth (int, optional): How many videos can be downloading/uploading at a time, which bounds
+      the disk space the run needs. Defaults to 2 * max_downloads.
+    - report_formats (tuple of str, optional): The formats of the run report (timings and counters of every
+      stage) saved in database_path: 'json', 'prometheus' and/or 'csv'. Defaults to ('json',).
+    - stats (RunStats, optional): The timings and counters of the run are recorded into it. Defaults to a new
+      RunStats, so runs in the same process don't mix their counters.
+    - transcoder (AudioTranscoder, optional): The format, sample rate and channels of the audio files, and whether
+      the audio stream is piped into ffmpeg instead of being downloaded first. Defaults to downloaded wav files.
     """
     if not database_path.exists():
         os.makedirs(database_path)
-    urls = get_youtube_urls(database_path,
-                            search_term=search_term,
-                            must_have_in_title_or_description=must_have_in_title,
-                            must_not_have_in_title_or_description=must_not_have_in_title_or_description,
-                            pickle_exists_only_download=False)
-    # create or update scanned_files.csv
-    scanned_files_path = database_path.joinpath('scanned_files.csv')
-    if not scanned_files_path.exists():
-        scanned_files = pd.DataFrame(columns=['url', 'video name'])
-        scanned_files.to_csv(scanned_files_path, index=False)
-
-    scanned_files = pd.read_csv(scanned_files_path)
-    for url in urls:
-        if url in scanned_files['url'].values:
-            print(f'skipping {url}: {urls[url]}')
-            continue
+    stats = stats or RunStats()
+    with stats.active():
+        # The urls are consumed while the search is still paging, so downloads start after the first page.
+        urls = iter_youtube_urls(database_path,
+                                 search_term=search_term,
+                                 must_have_in_title_or_description=must_have_in_title,
+                                 must_not_have_in_title_or_description=must_not_have_in_title_or_description,
+                                 pickle_exists_only_download=False,
+                                 whole_words=whole_words,
+                                 prescreen=prescreen,
+                                 query_variants=query_variants,
+                                 time_windows=time_windows,
+                                 casefold=casefold)
+        # The ledger keeps the downloaded urls. scanned_files.csv is exported from it at the end of the run.
+        ledger = DownloadLedger(database_path)
+        if media_store is None:
+            media_store = MediaStore(database_path.parent.joinpath('media_store'))
+        start_time = time.time()
+        trim_pool = ProcessPoolExecutor(max_workers=trim_workers) if trim else None
+        postprocess = SilenceTrimmer(trim_pool, output_format=trim_format) if trim else None
+        pipeline = DownloadPipeline(max_downloads, max_ffmpeg_jobs, retries, media_store, postprocess, uploader,
+                                    pipeline_depth, audio_from_video, transcoder)
+        upload_folder = sharepoint_search_folder(search_term) if uploader is not None else None
         try:
-            downloaded_from_youtube(database_path, url, with_video)
-            scanned_files.loc[len(scanned_files)] = (url, urls[url])
-            scanned_files.to_csv(scanned_files_path, index=False)
-            # upload_file_to_sharepoint(database_path.joinpath(urls[url]), search_term=search_term)
+            if uploader is not None:
+                pipeline.resume_uploads(ledger, upload_folder)
+            for url, title in urls:
+                if url in ledger:
+                    print(f'skipping {url}: {title}')
+                    continue
+                pipeline.submit(database_path, url, title, ledger, with_video, upload_folder)
+            pipeline.finish()
+        finally:
+            urls.close()
+            pipeline.shutdown()
+            ledger.export_csv()
+            ledger.close()
+            media_store.close()
+            if trim_pool is not None:
+                trim_pool.shutdown()
+            # Also when the run failed, that is when the timings are needed most.
+            stats.write(database_path, report_formats)
+
+        print_run_summary(start_time, pipeline.downloaded, len(pipeline.failed),
+                          pipeline.uploaded if uploader is not None else None)
+        if uploader is not None:
+            print(f'Done. The files were uploaded to SharePoint ({upload_folder}) and deleted locally, '
+                  f'url and name were saved in scanned_files.csv file.')
+        else:
+            print(f'Done. All the files in {database_path}'
+                  f'url and name were saved in scanned_files.csv file'
+                  f'Please upload them to SharePoint.'
+                  f'Delete all the files manually (without delete the scanned_files.csv) !!!!!.')
+
+
+def upload_files(uploader, files, upload_folder):
+    """
+    Upload the files of one video. Returns the files.
+    """
+    for file_path in files:
+        with run_stats().timer('upload'):
+            uploader.upload(file_path, upload_folder)
+        run_stats().count('upload_bytes', file_path.stat().st_size)
+    return files
+
+
+class DownloadPipeline:
+    """
+    The stages every found video goes through: download -> wav conversion and trimming -> upload -> local cleanup.
+
+    The downloads (with their conversion and trimming) run in one thread pool and the uploads in another,
+    and at most depth videos are in the pipeline at a time: submit() waits while it is full, so the search can't
+    run far ahead and the disk only holds the files of the videos that are in the pipeline.
+    A video is recorded in its ledger when its download finishes, and its local files are deleted only after
+    the ledger recorded that their upload finished.
+    Only the thread that calls submit() and finish() touches the ledgers, so the workers never race on them.
+
+    Parameters:
+    - max_downloads (int, optional): How many videos are downloaded at the same time. Defaults to 4.
+    - max_ffmpeg_jobs (int, optional): How many ffmpeg conversions run at the same time. Defaults to 2.
+    - retries (int, optional): How many times a failed download is retried. Defaults to 3.
+    - media_store (MediaStore, optional): See downloaded_from_youtube.
+    - postprocess (callable, optional): See downloaded_from_youtube.
+    - uploader (SharePointUploader, optional): If given, the files are uploaded and then deleted locally.
+    - depth (int, optional): How many videos can be in the pipeline. Defaults to 2 * max_downloads.
+    - audio_from_video (bool, optional): See downloaded_from_youtube.
+    - transcoder (AudioTranscoder, optional): See downloaded_from_youtube.
+    """
+
+    def __init__(self, max_downloads=4, max_ffmpeg_jobs=2, retries=3, media_store=None, postprocess=None,
+                 uploader=None, depth=None, audio_from_video=False, transcoder=None):
+        self.retries = retries
+        self.media_store = media_store
+        self.postprocess = postprocess
+        self.uploader = uploader
+        self.depth = depth or 2 * max_downloads
+        self.audio_from_video = audio_from_video
+        self.transcoder = transcoder
+        self.ffmpeg_slots = threading.BoundedSemaphore(max_ffmpeg_jobs)
+        # The workers record into the RunStats of the run that creates the pipeline.
+        self.download_pool = ThreadPoolExecutor(max_workers=max_downloads, initializer=run_stats().bind)
+        self.upload_pool = (ThreadPoolExecutor(max_workers=uploader.max_workers, initializer=run_stats().bind)
+                            if uploader is not None else None)
+        # future -> (stage, url, title, ledger, upload folder)
+        self.pending = dict()
+        self.downloaded = 0
+        self.uploaded = 0
+        self.failed = []
+        self.stopping = False
+
+    def submit(self, database_path, url, title, ledger, with_video=False, upload_folder=None):
+        """
+        Queue the download of a video. Waits while the pipeline is full.
+        """
+        future = self.download_pool.submit(download_with_retry, database_path, url, with_video, self.ffmpeg_slots,
+                                           self.retries, audio_from_video=self.audio_from_video,
+                                           media_store=self.media_store, postprocess=self.postprocess,
+                                           transcoder=self.transcoder)
+        self.pending[future] = ('download', url, title, ledger, upload_folder)
+        self.wait_for_room()
+
+    def submit_upload(self, url, title, ledger, files, upload_folder):
+        future = self.upload_pool.submit(upload_files, self.uploader, files, upload_folder)
+        self.pending[future] = ('upload', url, title, ledger, upload_folder)
+
+    def resume_uploads(self, ledger, upload_folder):
+        """
+        Queue the uploads that a previous run downloaded but didn't finish uploading.
+        A download whose files are gone (e.g. deleted by hand) is forgotten by the ledger and downloaded again,
+        and uploaded when the new download is recorded.
+        """
+        for url, title, files in ledger.pending_uploads():
+            missing = [file_path for file_path in files if not file_path.exists()]
+            if missing:
+                print(f'The upload of {url} is pending but {missing[0]} is gone, downloading it again')
+                run_stats().count('uploads_redownloaded')
+                ledger.forget(url)
+                # A download with the video has an audio and a video file.
+                self.submit(ledger.database_path, url, title, ledger, with_video=len(files) > 1,
+                            upload_folder=upload_folder)
+                continue
+            self.submit_upload(url, title, ledger, files, upload_folder)
+            self.wait_for_room()
+
+    def wait_for_room(self):
+        while len(self.pending) >= self.depth:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.record(done)
+
+    def record(self, done):
+        """
+        Record the finished futures in their ledgers and start the next stage of their videos.
+        """
+        for future in done:
+            stage, url, title, ledger, upload_folder = self.pending.pop(future)
+            try:
+                files = future.result()
+            except Exception as e:
+                print(f'Couldn\'t {stage} {url} because of error: \n {e}')
+                run_stats().failure(stage, e)
+                self.failed.append((url, title, ledger))
+                continue
+            if stage == 'download':
+                ledger.add(url, title, files)
+                self.downloaded += 1
+                run_stats().count('videos_downloaded')
+                # While stopping the download stays a pending upload in the ledger, the next run uploads it.
+                if self.uploader is not None and upload_folder is not None and not self.stopping:
+                    self.submit_upload(url, title, ledger, files, upload_folder)
+            else:
+                ledger.mark_uploaded(url)
+                self.uploaded += 1
+                run_stats().count('videos_uploaded')
+                self.clean_up(files)
+
+    def clean_up(self, files):
+        for file_path in files:
+            if self.media_store is not None:
+                self.media_store.release(file_path)
+            elif file_path.exists():
+                os.remove(file_path)
+
+    def finish(self):
+        """
+        Wait until every queued video went through all its stages.
+        """
+        while self.pending:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.record(done)
+
+    def shutdown(self):
+        """
+        Stop the pipeline, also when the run failed half way: the queued videos are cancelled, and the downloads
+        and uploads that are already running are waited for and recorded, so the ledgers match the files on disk.
+        """
+        self.stopping = True
+        for future in list(self.pending):
+            if future.cancel():
+                del self.pending[future]
+        self.finish()
+        self.download_pool.shutdown(cancel_futures=True)
+        if self.upload_pool is not None:
+            self.upload_pool.shutdown(cancel_futures=True)
+
+
+def print_run_summary(start_time, downloaded, failed, uploaded=None):
+    """
+    Print how many videos were downloaded (and uploaded) and the download rate in videos per minute.
+    """
+    minutes = (time.time() - start_time) / 60
+    videos_per_minute = downloaded / minutes if minutes else 0
+    uploaded = f', uploaded {uploaded}' if uploaded is not None else ''
+    print(f'Downloaded {downloaded} videos{uploaded} ({failed} failed) in {minutes:.1f} minutes: '
+          f'{videos_per_minute:.1f} videos/minute')
+
+
+def load_batch_manifest(manifest_path):
+    """
+    Read a batch manifest, a json file like:
+    {
+        "database_root": "/Volumes/p4client/RND/MainDev/RND/Idanko/AudioScrape",
+        "daily_quota": 10000,
+        "searches": [
+            {"search_term": "kick drum",
+             "must_have_in_title_or_description": ["foot", "kick", "bass", "pedal"],
+             "must_not_have_in_title_or_description": ["guitar", "slap"],
+             "with_video": true},
+            ...
+        ]
+    }
+    A search may set its own "database_path", the default is '{database_root}/{search_term} Search'
+    like in main(). database_root defaults to the folder of the manifest.
+    An optional "prescreen" dict holds the MetadataPrescreen limits of the batch,
+    e.g. {"max_duration_seconds": 600, "allow_live": false}.
+    A search may also set "query_variants" (more queries, e.g. synonyms) and "time_windows" (how many publish
+    date windows every query is split into), see search_slices, and "casefold" (unescape html and casefold the
+    title/description before matching the keywords, see KeywordFilter).
+
+    Returns the database root, the daily quota, the list of search specs (dicts with all the keys filled)
+    and the pre-screen limits.
+    """
+    with open(manifest_path, encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    database_root = Path(manifest.get('database_root', manifest_path.parent))
+    searches = []
+    for spec in manifest['searches']:
+        search_term = spec['search_term']
+        searches.append({
+            'search_term': search_term,
+            'must_have_in_title_or_description': spec.get('must_have_in_title_or_description', []),
+            'must_not_have_in_title_or_description': spec.get('must_not_have_in_title_or_description', []),
+            'with_video': spec.get('with_video', False),
+            'query_variants': spec.get('query_variants', []),
+            'time_windows': spec.get('time_windows', 1),
+            'casefold': spec.get('casefold', False),
+            'database_path': Path(spec.get('database_path', database_root.joinpath(f'{search_term} Search'))),
+        })
+    return database_root, manifest.get('daily_quota', 10000), searches, manifest.get('prescreen', dict())
+
+
+def run_batch(manifest_path, max_downloads=4, max_ffmpeg_jobs=2, retries=3, trim=True, trim_format='flac',
+              trim_workers=2, uploader=None, pipeline_depth=None, report_formats=('json',), transcoder=None,
+              prescreen_limits=None, stats=None):
+    """
+    Run all the searches of a batch manifest (see load_batch_manifest) under one scheduler.
+
+    - The daily API quota is split between the searches by a QuotaScheduler.
+    - The searches share one search cache and one download pool, and their results are interleaved,
+      so every search makes progress even when the quota runs out.
+    - A video is downloaded once even if several searches find it (by the shared MediaStore), and linked into
+      and recorded by every one of them.
+    - A search that paged through all its results without failed downloads is written to
+      batch_state.json and skipped when the batch is run again (e.g. the next day, when the quota is back).
+
+    Parameters:
+    - manifest_path (Path): The batch manifest.
+    - max_downloads (int, optional): How many videos are downloaded at the same time. Defaults to 4.
+    - max_ffmpeg_jobs (int, optional): How many ffmpeg conversions run at the same time. Defaults to 2.
+    - retries (int, optional): How many times a failed download is retried. Defaults to 3.
+    - trim, trim_format, trim_workers (optional): The silence trimming, see scrape_audio.
+    - uploader, pipeline_depth (optional): Upload to SharePoint and delete locally, see scrape_audio.
+    - report_formats (tuple of str, optional): The run report formats, see scrape_audio. Saved in database_root.
+    - transcoder (AudioTranscoder, optional): The audio format and streaming, see scrape_audio.
+    - prescreen_limits (dict, optional): MetadataPrescreen limits that override the manifest's "prescreen".
+    - stats (RunStats, optional): The timings and counters of the batch, see scrape_audio.
+    """
+    stats = stats or RunStats()
+    with stats.active():
+        database_root, daily_quota, searches, manifest_limits = load_batch_manifest(manifest_path)
+        prescreen_limits = dict(manifest_limits, **(prescreen_limits or dict()))
+        os.makedirs(database_root, exist_ok=True)
+        batch_state_path = database_root.joinpath('batch_state.json')
+        finished = []
+        if batch_state_path.exists():
+            with open(batch_state_path, encoding='utf-8') as state_file:
+                finished = json.load(state_file).get('finished', [])
+
+        for spec in searches:
+            os.makedirs(spec['database_path'], exist_ok=True)
+        # Everything per search is keyed by search_key(database_path), so searches in folders with the same name
+        # under different roots don't share a ledger or a quota share.
+        ledgers = {search_key(spec['database_path']): DownloadLedger(spec['database_path']) for spec in searches}
+        def is_finished(spec):
+            # The batch_state.json of older runs has the folder names.
+            return search_key(spec['database_path']) in finished or spec['database_path'].name in finished
+
+        searches = [spec for spec in searches if not is_finished(spec)]
+        quota_scheduler = QuotaScheduler(database_root.joinpath('quota_state.json'),
+                                         [search_key(spec['database_path']) for spec in searches], daily_quota)
+        search_cache = SearchCache(database_root.joinpath('youtube_search_cache'))
+        media_store = MediaStore(database_root.joinpath('media_store'))
+        prescreen = MetadataPrescreen(database_root.joinpath('video_metadata.sqlite'), **prescreen_limits)
+        video_index = VideoIndex(database_root.joinpath('video_index.sqlite'))
+        streams = dict()
+        for spec in searches:
+            urls = iter_youtube_urls(spec['database_path'],
+                                     spec['search_term'],
+                                     spec['must_have_in_title_or_description'],
+                                     spec['must_not_have_in_title_or_description'],
+                                     search_cache=search_cache,
+                                     quota_scheduler=quota_scheduler,
+                                     prescreen=prescreen,
+                                     query_variants=spec['query_variants'],
+                                     time_windows=spec['time_windows'],
+                                     casefold=spec['casefold'],
+                                     video_index=video_index)
+            streams[search_key(spec['database_path'])] = (spec, urls)
+
+        start_time = time.time()
+        paged_searches = set()
+        trim_pool = ProcessPoolExecutor(max_workers=trim_workers) if trim else None
+        postprocess = SilenceTrimmer(trim_pool, output_format=trim_format) if trim else None
+        pipeline = DownloadPipeline(max_downloads, max_ffmpeg_jobs, retries, media_store, postprocess, uploader,
+                                    pipeline_depth, transcoder=transcoder)
+        upload_folders = {search_key(spec['database_path']): sharepoint_search_folder(spec['search_term'])
+                          for spec in searches} if uploader is not None else dict()
+        try:
+            for name, folder in upload_folders.items():
+                pipeline.resume_uploads(ledgers[name], folder)
+            # Round robin over the searches, one result at a time, until all of them stopped paging.
+            while streams:
+                for name in list(streams):
+                    spec, urls = streams[name]
+                    try:
+                        url, title = next(urls)
+                    except StopIteration as stop:
+                        del streams[name]
+                        quota_scheduler.finish(name)
+                        if stop.value:
+                            paged_searches.add(name)
+                        continue
+                    # A video that another search downloaded is still submitted: the media store only links it.
+                    if url in ledgers[name]:
+                        print(f'skipping {url}: {title}')
+                        continue
+                    pipeline.submit(spec['database_path'], url, title, ledgers[name], spec['with_video'],
+                                    upload_folders.get(name))
+            pipeline.finish()
+        finally:
+            # The searches that didn't finish paging let go of the shared caches before they are closed.
+            for _, urls in streams.values():
+                urls.close()
+            pipeline.shutdown()
+            for ledger in ledgers.values():
+                ledger.export_csv()
+                ledger.close()
+            media_store.close()
+            prescreen.close()
+            video_index.close()
+            if trim_pool is not None:
+                trim_pool.shutdown()
+            stats.write(database_root, report_formats)
+
+        failed_searches = set(search_key(ledger.database_path) for _, _, ledger in pipeline.failed)
+        finished.extend(sorted(paged_searches - failed_searches))
+        with open(batch_state_path, 'w', encoding='utf-8') as state_file:
+            json.dump({'finished': finished}, state_file, indent=4)
+
+        print_run_summary(start_time, pipeline.downloaded, len(pipeline.failed),
+                          pipeline.uploaded if uploader is not None else None)
+        remaining = [spec['search_term'] for spec in searches if not is_finished(spec)]
+        if remaining:
+            print(f'Not finished yet, run the batch again (tomorrow if the quota is used): {remaining}')
+        else:
+            print('All the searches of the batch are finished.')
+
+
+# The low, mid and high frequency bands (Hz) of the band vs. single instrument classification.
+DEFAULT_BANDS = ((0, 1000), (1000, 5000), (5000, None))
+# Part of the FeatureCache key of the band energies. Bump it whenever their computation changes (e.g. the sample
+# scaling), so the features cached by the older code aren't mixed with the new ones.
+BAND_ENERGIES_VERSION = 2
+
+
+class FeatureCache:
+    """
+    SQLite cache of per-file audio features, so analysing a folder again only analyses the new or changed files.
+    A file is identified by the sha256 of its content, so the hardlinks of one media store object in many search
+    folders (and renamed files) share their features, and the features by the name of the analysis and its
+    parameters. The hash of a path is remembered with its size and modification time, so an unchanged file
+    is hashed once.
+    """
+
+    def __init__(self, cache_path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS features '
+                                '(file_key TEXT, analysis TEXT, features BLOB, PRIMARY KEY (file_key, analysis))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS file_hashes '
+                                '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)')
+        self.connection.commit()
+
+    def file_keys(self, file_paths):
+        """
+        The content hashes of many files. The hashes of the new or changed files are saved in one transaction.
+        """
+        keys, new_rows = [], []
+        for file_path in file_paths:
+            stat = file_path.stat()
+            path = str(file_path.resolve())
+            with self.lock:
+                row = self.connection.execute('SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path = ?',
+                                              (path,)).fetchone()
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                keys.append(row[2])
+                continue
+            sha256 = file_sha256(file_path)
+            new_rows.append((path, stat.st_size, stat.st_mtime_ns, sha256))
+            keys.append(sha256)
+        if new_rows:
+            with self.lock:
+                self.connection.executemany('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)', new_rows)
+                self.connection.commit()
+        return keys
+
+    def get(self, file_path, analysis):
+        return self.get_many([file_path], analysis)[0]
+
+    def get_many(self, file_paths, analysis):
+        """
+        The cached features of many files, None for the files that weren't analysed.
+        """
+        results = []
+        for file_key in self.file_keys(file_paths):
+            with self.lock:
+                row = self.connection.execute('SELECT features FROM features WHERE file_key = ? AND analysis = ?',
+                                              (file_key, analysis)).fetchone()
+            results.append(None if row is None else np.frombuffer(row[0], dtype=np.float64))
+        return results
+
+    def put_many(self, items, analysis):
+        """
+        Save the features of many files, items is a list of (file_path, features).
+        """
+        file_keys = self.file_keys([file_path for file_path, _ in items])
+        rows = [(file_key, analysis, np.asarray(features, dtype=np.float64).tobytes())
+                for file_key, (_, features) in zip(file_keys, items)]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?)', rows)
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class BandEnergyBatch:
+    """
+    Accumulates STFT frames of many files and computes their band energies with one FFT per batch.
+    Frames are grouped by sample rate, because the frequency of every FFT bin depends on it.
+    """
+
+    def __init__(self, n_files, frame_size, bands, batch_frames):
+        self.frame_size = frame_size
+        self.bands = bands
+        self.batch_frames = batch_frames
+        self.window = np.hanning(frame_size).astype(np.float32)
+        self.sums = np.zeros((n_files, len(bands)))
+        self.counts = np.zeros(n_files)
+        self.pending = dict()
+
+    def add(self, file_index, sample_rate, frames):
+        pending = self.pending.setdefault(sample_rate, [])
+        pending.append((file_index, frames))
+        if sum(len(frames) for _, frames in pending) >= self.batch_frames:
+            self.flush(sample_rate)
+
+    def flush(self, sample_rate):
+        pending = self.pending.pop(sample_rate, [])
+        if not pending:
+            return
+        frames = np.concatenate([frames for _, frames in pending])
+        owners = np.repeat([file_index for file_index, _ in pending], [len(frames) for _, frames in pending])
+        spectrum = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        frequencies = np.fft.rfftfreq(self.frame_size, 1 / sample_rate)
+        for band_index, (low, high) in enumerate(self.bands):
+            # Like the original masks: the first band includes its low edge, the others don't.
+            mask = (frequencies >= low) if band_index == 0 else (frequencies > low)
+            if high is not None:
+                mask &= frequencies <= high
+            np.add.at(self.sums[:, band_index], owners, spectrum[:, mask].mean(axis=1))
+        self.counts += np.bincount(owners, minlength=len(self.counts))
+
+    def energies(self):
+        for sample_rate in list(self.pending):
+            self.flush(sample_rate)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts[:, None]
+
+
+def iter_audio_chunks(file_path, frame_size, chunk_frames):
+    """
+    Yield (sample rate, mono float32 chunk) of an audio file, chunk_frames frames of frame_size samples at a time.
+    The samples after the last full frame are dropped. wav files are memory mapped and scaled to [-1, 1), other formats (e.g. the
+    trimmed flac files) are decoded block by block with soundfile.
+    """
+    chunk_size = chunk_frames * frame_size
+    if file_path.suffix.lower() == '.wav':
+        from scipy.io import wavfile
+        sample_rate, data = wavfile.read(file_path, mmap=True)
+        usable_length = len(data) // frame_size * frame_size
+        for start in range(0, usable_length, chunk_size):
+            chunk = np.asarray(data[start:min(start + chunk_size, usable_length)], dtype=np.float32)
+            # Scale integer samples to [-1, 1) like soundfile does, so wav and flac features are comparable.
+            if data.dtype == np.uint8:
+                chunk = (chunk - 128) / 128
+            elif np.issubdtype(data.dtype, np.integer):
+                chunk /= np.iinfo(data.dtype).max + 1
+            yield sample_rate, chunk.mean(axis=1) if chunk.ndim > 1 else chunk
+        return
+    with sf.SoundFile(str(file_path)) as audio_file:
+        for block in audio_file.blocks(blocksize=chunk_size, dtype='float32', always_2d=True):
+            usable_length = len(block) // frame_size * frame_size
+            if usable_length:
+                yield audio_file.samplerate, block[:usable_length].mean(axis=1)
+
+
+def batch_band_energies(file_paths, frame_size=4096, chunk_frames=256, batch_frames=4096, bands=DEFAULT_BANDS,
+                        cache=None):
+    """
+    Compute the mean STFT magnitude of every frequency band of many wav files.
+
+    The files are read in chunks of chunk_frames frames (see iter_audio_chunks), so a long file is never fully
+    loaded, and the frames of many files go through NumPy's FFT together, batch_frames frames at a time.
+
+    Parameters:
+    - file_paths (list of Path): The wav/flac files.
+    - frame_size (int, optional): The STFT frame length in samples. Defaults to 4096.
+    - chunk_frames (int, optional): How many frames are read from a file at a time. Defaults to 256.
+    - batch_frames (int, optional): How many frames are transformed in one FFT call. Defaults to 4096.
+    - bands (tuple of (low, high), optional): The frequency bands in Hz, high=None means up to Nyquist.
+    - cache (FeatureCache, optional): Features of files that didn't change are read from it, new ones are saved.
+
+    Returns an array of shape (len(file_paths), len(bands)) and the list of the files that couldn't be read
+    or are shorter than one frame (their rows are NaN).
+    """
+    analysis = f'band_energies|v{BAND_ENERGIES_VERSION}|{frame_size}|{bands}'
+    features = np.full((len(file_paths), len(bands)), np.nan)
+    to_analyse = []
+    cached_features = cache.get_many(file_paths, analysis) if cache is not None else [None] * len(file_paths)
+    for file_index, cached in enumerate(cached_features):
+        if cached is not None:
+            features[file_index] = cached
+        else:
+            to_analyse.append(file_index)
+
+    batch = BandEnergyBatch(len(file_paths), frame_size, bands, batch_frames)
+    failed_files = []
+    for file_index in to_analyse:
+        try:
+            for sample_rate, chunk in iter_audio_chunks(file_paths[file_index], frame_size, chunk_frames):
+                batch.add(file_index, sample_rate, chunk.reshape(-1, frame_size))
         except Exception as e:
-            print(f'Couldn\'t download because of error: \n {e}')
+            print(f'Couldn\'t read {file_paths[file_index]}: {e}')
+            failed_files.append(file_paths[file_index])
+
+    energies = batch.energies()
+    failed = set(failed_files)
+    analysed = [file_index for file_index in to_analyse if file_paths[file_index] not in failed]
+    features[analysed] = energies[analysed]
+    for file_index in analysed:
+        if np.isnan(features[file_index]).any():
+            print(f'Couldn\'t analyse {file_paths[file_index]}: shorter than one frame ({frame_size} samples)')
+            failed_files.append(file_paths[file_index])
+    if cache is not None:
+        cache.put_many([(file_paths[file_index], features[file_index]) for file_index in analysed
+                        if not np.isnan(features[file_index]).any()], analysis)
+    return features, failed_files
+
+
+def fit_thresholds(reference_features):
+    """
+    The thresholds that minimise the squared error to the features of the reference files.
+    That is the mean of the features, which is what the 200^3 grid search of the old find_best_thresholds
+    was approximating.
+    """
+    return np.nanmean(reference_features, axis=0)
 
-    print(f'Done. All the files in {database_path}'
-          f'url and name were saved in scanned_files.csv file'
-          f'Please upload them to SharePoint.'
-          f'Delete all the files manually (without delete the scanned_files.csv) !!!!!.')
-    
 
-def main():
+def classify_band(features, thresholds):
     """
-    This function is the entry point for scraping audio files from YouTube based on specific search criteria
-    and processing them (a future feature). It allows you to customize your search criteria and control
-    whether to download videos along with audio.
+    Return a boolean array, True for the files that may be a full band
+    (all their band energies are above the thresholds) and False for single instrument files.
+    """
+    return np.all(features > thresholds, axis=1)
+
+
+def audio_files(folder):
+    return sorted(file for file in folder.iterdir() if file.suffix.lower() in ('.wav', '.flac'))
+
+
+def process_audio(database_path, reference_path):
+    """
+    Classify the wav/flac files of a search folder as full band or single instrument samples.
+
+    The thresholds are fitted on the wav/flac files in reference_path (e.g. a few samples of single acoustic bass),
+    and both folders keep a features cache (analysis_cache.sqlite), so running it again is incremental.
+    The result is written to 'classification.csv' in database_path.
+
+    Returns the lists of band samples, single instrument samples and files that failed.
+    """
+    reference_cache = FeatureCache(reference_path.joinpath('analysis_cache.sqlite'))
+    cache = FeatureCache(database_path.joinpath('analysis_cache.sqlite'))
+    try:
+        reference_files = audio_files(reference_path)
+        reference_features, _ = batch_band_energies(reference_files, cache=reference_cache)
+        thresholds = fit_thresholds(reference_features)
+        print(f'thresholds (low, mid, high): {thresholds}')
+
+        files = audio_files(database_path)
+        features, failed_files = batch_band_energies(files, cache=cache)
+    finally:
+        reference_cache.close()
+        cache.close()
+
+    is_band = classify_band(features, thresholds)
+    failed = set(failed_files)
+    band_samples = [file for file, band in zip(files, is_band) if band and file not in failed]
+    single_instrument = [file for file, band in zip(files, is_band) if not band and file not in failed]
+    with open(database_path.joinpath('classification.csv'), 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['file', 'low', 'mid', 'high', 'classification'])
+        for file, file_features, band in zip(files, features, is_band):
+            classification = 'failed' if file in failed else ('band' if band else 'single instrument')
+            writer.writerow([file.name, *file_features, classification])
+
+    print(f'{len(band_samples)} band samples, {len(single_instrument)} single instrument samples, '
+          f'{len(failed_files)} failed')
+    return band_samples, single_instrument, failed_files
+
+
+# Part of the FeatureCache key of the timbre features, bump it whenever timbre_features changes.
+TIMBRE_FEATURES_VERSION = 1
+# The rows of librosa's spectral contrast: its default 6 bands and the residual.
+SPECTRAL_CONTRAST_ROWS = 7
+
+
+def timbre_feature_width(n_mfcc=20):
+    """
+    The length of the timbre_features of a file: the mean and standard deviation of n_mfcc MFCCs,
+    the spectral contrast rows and the 6 other descriptors.
+    """
+    return 2 * (n_mfcc + SPECTRAL_CONTRAST_ROWS + 6)
+
+
+def timbre_features(file_path, sample_rate=22050, n_mfcc=20, max_seconds=180):
+    """
+    The timbre features of an audio file: the mean and standard deviation of its MFCCs, spectral centroid,
+    bandwidth, rolloff, flatness and contrast, zero crossing rate and RMS, computed with librosa.
+    Only the first max_seconds seconds are analysed (None for the whole file), which is enough to describe a clip
+    and keeps the memory of long downloads bounded.
+    It runs in the processes of a pool, so it takes and returns plain values.
+    """
+    import librosa
+    signal, sample_rate = librosa.load(str(file_path), sr=sample_rate, mono=True, duration=max_seconds)
+    spectrum = np.abs(librosa.stft(signal))
+    descriptors = [
+        librosa.feature.mfcc(y=signal, sr=sample_rate, n_mfcc=n_mfcc),
+        librosa.feature.spectral_centroid(S=spectrum, sr=sample_rate),
+        librosa.feature.spectral_bandwidth(S=spectrum, sr=sample_rate),
+        librosa.feature.spectral_rolloff(S=spectrum, sr=sample_rate),
+        librosa.feature.spectral_flatness(S=spectrum),
+        librosa.feature.spectral_contrast(S=spectrum, sr=sample_rate),
+        librosa.feature.zero_crossing_rate(signal),
+        librosa.feature.rms(S=spectrum),
+    ]
+    frames = np.vstack(descriptors)
+    return np.concatenate([frames.mean(axis=1), frames.std(axis=1)])
+
+
+def extract_timbre_features(file_paths, cache=None, workers=4, sample_rate=22050, n_mfcc=20, max_seconds=180):
+    """
+    Compute timbre_features of many files in a pool of worker processes.
+    Features of files whose content was analysed before are read from cache (a FeatureCache), and the new ones
+    are saved to it as they finish, so an interrupted run keeps its work.
+
+    Returns an array with a row per file and the list of the files that couldn't be analysed (their rows are NaN).
+    """
+    analysis = f'timbre|v{TIMBRE_FEATURES_VERSION}|{sample_rate}|{n_mfcc}|{max_seconds}'
+    features = [None] * len(file_paths)
+    to_analyse = []
+    cached_features = cache.get_many(file_paths, analysis) if cache is not None else [None] * len(file_paths)
+    for file_index, cached in enumerate(cached_features):
+        if cached is not None:
+            features[file_index] = cached
+        else:
+            to_analyse.append(file_index)
+
+    failed_files = []
+    if to_analyse:
+        print(f'Analysing {len(to_analyse)} files ({len(file_paths) - len(to_analyse)} cached)')
+        done = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(timbre_features, file_paths[file_index], sample_rate, n_mfcc, max_seconds):
+                       file_index for file_index in to_analyse}
+            for future in as_completed(futures):
+                file_index = futures[future]
+                try:
+                    features[file_index] = future.result()
+                except Exception as e:
+                    print(f'Couldn\'t analyse {file_paths[file_index]}: {e}')
+                    failed_files.append(file_paths[file_index])
+                    continue
+                done.append((file_paths[file_index], features[file_index]))
+                if cache is not None and len(done) >= 100:
+                    cache.put_many(done, analysis)
+                    done = []
+        if cache is not None and done:
+            cache.put_many(done, analysis)
+
+    # The width is known even if no file could be analysed, so the failed files are NaN rows, not empty ones.
+    matrix = np.full((len(file_paths), timbre_feature_width(n_mfcc)), np.nan)
+    for file_index, row in enumerate(features):
+        if row is not None:
+            matrix[file_index] = row
+    return matrix, failed_files
+
+
+class EmbeddingIndex:
+    """
+    A nearest neighbour index of the audio files of a corpus by cosine similarity of their timbre features.
+
+    Every feature is standardised over the corpus (so MFCCs and spectral centroids in Hz weigh the same) and
+    every row is normalised, so a query is one matrix product: tens of thousands of files take milliseconds.
 
     Parameters:
-    - search_term (str): The search term used to find relevant YouTube videos.
-    - must_have_in_title_or_description (list of str): A list of keywords that must be present either in the
-      video title or description for the video to be downloaded. At least one keyword from this list must match.
-    - must_not_have_in_title_or_description (list of str): A list of keywords that must not be present either in the
-      video title or description for the video to be downloaded. If any keyword from this list matches, the video
-      will not be downloaded.
-    - with_video (bool, optional): If True, download the video along with the audio. Defaults to True.
-
-    Notes:
-    - The 'search_term' parameter should be a descriptive keyword or phrase to narrow down your search.
-    - 'must_have_in_title_or_description' should contain keywords that help filter relevant videos.
-    - 'must_not_have_in_title_or_description' should contain keywords to exclude unwanted videos.
-    - The 'with_video' parameter controls whether video files are downloaded in addition to audio.
+    - file_paths (list of Path): The files of the index.
+    - features (array): Their features, a row per file (rows with NaN are left out).
+      Raises ValueError if no row is left, an index of no features would rank arbitrary files.
+    - corpus (list of str, optional): The corpus_signature of the files the index was built from,
+      saved with it so a saved index can tell if it is out of date.
     """
-    
-    search_term = 'male choir'
-    must_have_in_title_or_description = ['male', 'men', 'man', 'boy']
-    must_not_have_in_title_or_description = ['women', 'girl']
-    with_video = True
 
-    database_path = Path(f'/Volumes/p4client/RND/MainDev/RND/Idanko/AudioScrape/{search_term} Search')
+    def __init__(self, file_paths, features, corpus=()):
+        self.corpus = list(corpus)
+        valid = ~np.isnan(features).any(axis=1)
+        if features.ndim != 2 or not features.shape[1] or not valid.any():
+            raise ValueError(f'None of the {len(file_paths)} files has features to index')
+        self.file_paths = [file_path for file_path, is_valid in zip(file_paths, valid) if is_valid]
+        features = features[valid]
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0)
+        self.std[self.std == 0] = 1
+        self.vectors = self.embed(features)
+
+    def embed(self, features):
+        vectors = ((np.atleast_2d(features) - self.mean) / self.std).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def similar(self, reference_features, k=50, exclude=()):
+        """
+        Return the k files most like the reference files (rows of features), as (path, similarity) pairs.
+        A file's similarity is its mean cosine similarity to the references, files in exclude are skipped.
+        """
+        scores = (self.vectors @ self.embed(reference_features).T).mean(axis=1)
+        excluded = set(Path(file_path).resolve() for file_path in exclude)
+        order = np.argsort(-scores)
+        results = []
+        for file_index in order:
+            if self.file_paths[file_index].resolve() in excluded:
+                continue
+            results.append((self.file_paths[file_index], float(scores[file_index])))
+            if len(results) == k:
+                break
+        return results
+
+    def save(self, index_path):
+        np.savez(index_path, file_paths=np.array([str(file_path) for file_path in self.file_paths], dtype=str),
+                 vectors=self.vectors, mean=self.mean, std=self.std, corpus=np.array(self.corpus, dtype=str))
+
+    @classmethod
+    def load(cls, index_path):
+        data = np.load(index_path)
+        index = cls.__new__(cls)
+        index.file_paths = [Path(file_path) for file_path in data['file_paths']]
+        index.vectors, index.mean, index.std = data['vectors'], data['mean'], data['std']
+        index.corpus = list(data['corpus']) if 'corpus' in data.files else []
+        return index
+
+
+def corpus_files(database_root):
+    """
+    The audio files of all the search folders under database_root, one path per content
+    (a video found by several searches is hardlinked into each of them).
+    """
+    files = []
+    seen = set()
+    for folder in sorted(database_root.iterdir()):
+        if not folder.is_dir() or folder.name in ('media_store', 'youtube_search_cache'):
+            continue
+        for file_path in audio_files(folder):
+            stat = file_path.stat()
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                files.append(file_path)
+    return files
 
-    scrape_audio(database_path,
-                 search_term,
-                 must_have_in_title_or_description,
-                 must_not_have_in_title_or_description,
-                 with_video=with_video)
 
-    # process_audio(database_path) # Future feature
+def corpus_signature(files):
+    """
+    The path, size and modification time of every file, sorted: it changes when a file is added,
+    removed or rewritten.
+    """
+    signature = []
+    for file_path in files:
+        stat = file_path.stat()
+        signature.append(f'{file_path}\t{stat.st_size}\t{stat.st_mtime_ns}')
+    return sorted(signature)
 
 
-if __name__ == '__main__':
-    main()
+def analyze_corpus(database_root, workers=4, files=None):
+    """
+    The analyze stage: extract the timbre features of every downloaded audio file under database_root
+    (cached by content in 'analysis_cache.sqlite', so only new downloads are analysed) and build the
+    nearest neighbour index, which is saved to 'embedding_index.npz'. files defaults to corpus_files(database_root).
 
+    Returns the EmbeddingIndex.
+    """
+    files = corpus_files(database_root) if files is None else files
+    cache = FeatureCache(database_root.joinpath('analysis_cache.sqlite'))
+    try:
+        features, failed_files = extract_timbre_features(files, cache=cache, workers=workers)
+    finally:
+        cache.close()
+    index = EmbeddingIndex(files, features, corpus_signature(files))
+    index.save(database_root.joinpath('embedding_index.npz'))
+    print(f'Indexed {len(index.file_paths)} files ({len(failed_files)} failed)')
+    return index
 
-#@TODO:
-    # 1) Trim leading and trailing silence from an audio signal.
-    # 1) Delete files that contain band.
-    # 2) Trim people talking and remain only bass parts.
 
+def corpus_index(database_root, workers=4):
+    """
+    The saved 'embedding_index.npz' of database_root, or a new one (see analyze_corpus) if there is none
+    or the audio files changed since it was built.
+    """
+    index_path = database_root.joinpath('embedding_index.npz')
+    files = corpus_files(database_root)
+    if index_path.exists():
+        index = EmbeddingIndex.load(index_path)
+        if index.corpus == corpus_signature(files):
+            print(f'The index of {len(index.file_paths)} files is up to date')
+            return index
+    return analyze_corpus(database_root, workers, files)
 
 
+def find_similar(database_root, reference_files, k=50, workers=4):
+    """
+    Find the k downloaded files that sound most like the reference files (e.g. a few bass only samples).
+    The saved index is used, and the analyze stage runs first only if the downloads changed since it was built.
 
+    Returns a list of (path, similarity) pairs, the most similar first.
+    """
+    index = corpus_index(database_root, workers)
+    if not index.file_paths:
+        return []
+    cache = FeatureCache(database_root.joinpath('analysis_cache.sqlite'))
+    try:
+        reference_features, failed_files = extract_timbre_features(reference_files, cache=cache, workers=workers)
+    finally:
+        cache.close()
+    reference_features = reference_features[~np.isnan(reference_features).any(axis=1)]
+    if not len(reference_features):
+        raise ValueError(f'Couldn\'t analyse any of the reference files: {failed_files}')
+    return index.similar(reference_features, k, exclude=reference_files)
 
 
+# The folder of the searches when --database-root isn't given: $AUDIO_SCRAPE_ROOT, or the current directory.
+DEFAULT_DATABASE_ROOT = Path(os.environ.get('AUDIO_SCRAPE_ROOT') or os.getcwd())
 
 
+def search_database_path(args):
+    """
+    The folder of the search of the parsed arguments: --database-path, or '{database root}/{search term} Search'.
+    """
+    return args.database_path or args.database_root.joinpath(f'{args.search_term} Search')
 
-    # with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-    #     info_dict = ydl.extract_info(url, download=False)
-    #     video_size = info_dict.get('filesize') / (1024 * 1024)  # convert to MB
-    #     print(f'video_size={video_size}')
-    #     if video_size <= 50:
-    #         print('can download')
-    #     else:
-    #         print(f"Video is too large ({video_size:.2f} MB), skipping download.")
 
-    # if with_video:
-    #     ydl_opts = {
-    #         'outtmpl': str(database_path.joinpath('%(title)s.%(ext)s')),
-    #
-    #     }
-    # with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-    #     ydl.download([url])
+def sharepoint_uploader(state_dir):
+    """
+    A SharePointUploader that saves its unfinished upload sessions in state_dir, so they resume on the next run.
+    """
+    return SharePointUploader(state_path=state_dir.joinpath('upload_sessions.json'))
 
-# def spectral_analysis(file):
-#     # Read in the audio file
-#     fs, data = wavfile.read(file)
-#
-#     # Perform FFT on the audio data
-#     spectrum = np.abs(fft(data))
-#
-#     # Get the frequency values corresponding to the FFT data
-#     frequencies = np.fft.fftfreq(len(spectrum), 1 / fs)
-#
-#     # Calculate the average amplitude for the low, mid, and high frequency bands
-#     low_freq_band = spectrum[(frequencies >= 0) & (frequencies <= 1000)].mean()
-#     mid_freq_band = spectrum[(frequencies > 1000) & (frequencies <= 5000)].mean()
-#     high_freq_band = spectrum[(frequencies > 5000)].mean()
-#
-#     return low_freq_band, mid_freq_band, high_freq_band
-#
-# # Find the best threshold values
-# def find_best_thresholds_2(bass_only_path):
-#     instrument_files = [bass_only_path.joinpath(file) for file in os.listdir(bass_only_path)]
-#     low_thresholds = []
-#     mid_thresholds = []
-#     high_thresholds = []
-#     for file in instrument_files:
-#         fs, data = wavfile.read(file)
-#         spectrum = np.abs(fft(data))
-#         frequencies = np.fft.fftfreq(len(spectrum), 1/fs)
-#         low_thresholds.append(spectrum[(frequencies >= 0) & (frequencies <= 1000)].mean())
-#         mid_thresholds.append(spectrum[(frequencies > 1000) & (frequencies <= 5000)].mean())
-#         high_thresholds.append(spectrum[(frequencies > 5000)].mean())
-#     best_low_threshold = np.mean(low_thresholds)
-#     best_mid_threshold = np.mean(mid_thresholds)
-#     best_high_threshold = np.mean(high_thresholds)
-#     return best_low_threshold, best_mid_threshold, best_high_threshold
+
+def metadata_prescreen(args, database_root):
+    """
+    The MetadataPrescreen of the search/download commands, with the limits of the parsed arguments.
+    """
+    return MetadataPrescreen(database_root.joinpath('video_metadata.sqlite'), **prescreen_limits(args))
+
+
+def prescreen_limits(args):
+    """
+    The MetadataPrescreen limits that were given on the command line (a max duration of 0 means no limit).
+    """
+    limits = {'max_duration_seconds': args.max_duration, 'min_duration_seconds': args.min_duration,
+              'allow_live': args.allow_live or None, 'definition': args.definition}
+    limits = {name: value for name, value in limits.items() if value is not None}
+    if limits.get('max_duration_seconds') == 0:
+        limits['max_duration_seconds'] = None
+    return limits
+
+
+def audio_transcoder(args):
+    return AudioTranscoder(stream=args.stream, sample_rate=args.sample_rate, channels=args.channels,
+                           audio_format=args.audio_format)
+
+
+def search_command(args):
+    database_path = search_database_path(args)
+    os.makedirs(database_path, exist_ok=True)
+    prescreen = metadata_prescreen(args, database_path.parent)
+    try:
+        urls = get_youtube_urls(database_path, args.search_term, args.must_have, args.must_not_have,
+                                whole_words=args.whole_words, prescreen=prescreen, query_variants=args.variants,
+                                time_windows=args.time_windows, casefold=args.casefold)
+    finally:
+        prescreen.close()
+    print(f'{len(urls)} videos found for {args.search_term}, run the download command to download them.')
+
+
+def download_command(args):
+    database_path = search_database_path(args)
+    os.makedirs(database_path, exist_ok=True)
+    prescreen = metadata_prescreen(args, database_path.parent)
+    try:
+        scrape_audio(database_path,
+                     args.search_term,
+                     args.must_have,
+                     args.must_not_have,
+                     with_video=args.with_video,
+                     max_downloads=args.max_downloads,
+                     max_ffmpeg_jobs=args.max_ffmpeg_jobs,
+                     retries=args.retries,
+                     audio_from_video=args.audio_from_video,
+                     whole_words=args.whole_words,
+                     trim=args.trim,
+                     trim_format=args.trim_format,
+                     trim_workers=args.trim_workers,
+                     prescreen=prescreen,
+                     uploader=sharepoint_uploader(database_path) if args.upload else None,
+                     pipeline_depth=args.pipeline_depth,
+                     report_formats=args.report_format,
+                     query_variants=args.variants,
+                     time_windows=args.time_windows,
+                     casefold=args.casefold,
+                     transcoder=audio_transcoder(args))
+    finally:
+        prescreen.close()
+
+
+def batch_command(args):
+    run_batch(args.manifest,
+              max_downloads=args.max_downloads,
+              max_ffmpeg_jobs=args.max_ffmpeg_jobs,
+              retries=args.retries,
+              trim=args.trim,
+              trim_format=args.trim_format,
+              trim_workers=args.trim_workers,
+              uploader=sharepoint_uploader(args.manifest.parent) if args.upload else None,
+              pipeline_depth=args.pipeline_depth,
+              report_formats=args.report_format,
+              transcoder=audio_transcoder(args),
+              prescreen_limits=prescreen_limits(args))
+
+
+def analyze_command(args):
+    process_audio(search_database_path(args), args.reference_path)
+
+
+def analyze_corpus_command(args):
+    corpus_index(args.database_root, args.workers)
+
+
+def similar_command(args):
+    similar = find_similar(args.database_root, args.reference_files, k=args.k, workers=args.workers)
+    for file_path, similarity in similar:
+        print(f'{similarity:.3f} {file_path}')
+
+
+def upload_command(args):
+    """
+    Upload the downloads of a search whose upload wasn't confirmed in its ledger, and delete them locally.
+    """
+    database_path = search_database_path(args)
+    ledger = DownloadLedger(database_path)
+    media_store = MediaStore(database_path.parent.joinpath('media_store'))
+    pipeline = DownloadPipeline(media_store=media_store, uploader=sharepoint_uploader(database_path))
+    try:
+        pipeline.resume_uploads(ledger, sharepoint_search_folder(args.search_term))
+        pipeline.finish()
+    finally:
+        pipeline.shutdown()
+        ledger.export_csv()
+        ledger.close()
+        media_store.close()
+    print(f'Uploaded {pipeline.uploaded} videos ({len(pipeline.failed)} failed).')
+
+
+def ledger_command(args):
+    """
+    Print what the ledger of a search knows, without searching or downloading anything.
+    """
+    database_path = search_database_path(args)
+    if not database_path.joinpath('scanned_files.sqlite').exists() \
+            and not database_path.joinpath('scanned_files.csv').exists():
+        sys.exit(f'{database_path} has no ledger')
+    ledger = DownloadLedger(database_path)
+    try:
+        if args.contains:
+            downloaded = args.contains in ledger
+            print(f'{args.contains} was {"" if downloaded else "not "}downloaded')
+            sys.exit(0 if downloaded else 1)
+        pending = ledger.pending_uploads()
+        if args.pending:
+            for url, video_name, _ in pending:
+                print(f'{url} {video_name}')
+        elif args.list:
+            for url, video_name, scanned_at, uploaded_at in ledger.entries():
+                print(f'{url} {video_name} (downloaded {scanned_at or "-"}, uploaded {uploaded_at or "-"})')
+        else:
+            print(f'{args.search_term}: {len(ledger)} videos downloaded, {len(pending)} uploads pending')
+    finally:
+        ledger.close()
+
+
+def index_command(args):
+    """
+    Print the videos of the video index that match the filters.
+    """
+    # A search with its own --database-path is indexed next to its folder, under the folder's name.
+    if args.database_path is not None:
+        database_root, search = args.database_path.parent, args.database_path.name
+    else:
+        database_root, search = args.database_root, f'{args.search} Search' if args.search else None
+    index_path = database_root.joinpath('video_index.sqlite')
+    if not index_path.exists():
+        sys.exit(f'{database_root} has no video index')
+    video_index = VideoIndex(index_path)
+    try:
+        videos = video_index.query(search=search,
+                                   since=datetime.datetime.fromisoformat(args.since) if args.since else None,
+                                   text=args.text, channel=args.channel, limit=args.limit)
+    finally:
+        video_index.close()
+    if args.count:
+        print(len(videos))
+        return
+    for video_id, title, channel, first_seen, searches in videos:
+        print(f'{video_id} {title} ({channel or "-"}, first seen {first_seen}, found by {searches or "-"})')
+
+
+def main(argv=None):
+    """
+    This function is the entry point for scraping audio files from YouTube based on specific search criteria
+    and processing them. The search is given on the command line, e.g.:
+
+    python main.py download "male choir" --must-have male men man boy --must-not-have women girl --with-video
+
+    Subcommands:
+    - search: Page through the search and save the matching videos (in video_index.sqlite).
+    - download: Search and download (convert, trim and optionally upload) the videos, see scrape_audio.
+    - batch: Run a batch manifest of searches, see run_batch.
+    - analyze: Classify the downloaded files as band or single instrument samples, see process_audio.
+    - similar: Index the timbre of all the downloads and list the files most like some reference files,
+      see find_similar.
+    - upload: Upload the downloads of a search whose upload didn't finish.
+    - ledger: Query the ledger of a search (how many were downloaded, pending uploads, is a url downloaded).
+    - index: Query the videos that the searches found, across days and searches.
+
+    The heavy libraries (youtube_dl, googleapiclient, office365, numpy, scipy, soundfile) are imported only when a
+    subcommand uses them, so --help and ledger queries start fast.
+    """
+    parser = argparse.ArgumentParser(description='Scrape audio samples from YouTube.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    def add_search_arguments(subparser, keywords=True):
+        subparser.add_argument('search_term', help='The YouTube search term, e.g. "male choir".')
+        if keywords:
+            subparser.add_argument('--must-have', nargs='*', default=[], metavar='WORD',
+                                   help='At least one of the words must be in the title or description.')
+            subparser.add_argument('--must-not-have', nargs='*', default=[], metavar='WORD',
+                                   help='None of the words may be in the title or description.')
+            subparser.add_argument('--whole-words', action='store_true',
+                                   help='Match whole words only (so "bass" doesn\'t match "bassoon").')
+            subparser.add_argument('--casefold', action='store_true',
+                                   help='Unescape html and casefold the title and description before matching '
+                                        '(e.g. "&#39;" and "STRASSE"/"straße"), instead of only lowercasing them.')
+            subparser.add_argument('--variants', nargs='*', default=[], metavar='QUERY',
+                                   help='More queries of the search (e.g. synonyms), to find more videos.')
+            subparser.add_argument('--time-windows', type=int, default=1,
+                                   help='Split every query into this many publish date windows, to find more videos.')
+        subparser.add_argument('--database-root', type=Path, default=DEFAULT_DATABASE_ROOT,
+                               help='The folder of the searches, the search is saved to "{root}/{search term} Search".')
+        subparser.add_argument('--database-path', type=Path, help='The folder of the search, instead of the default.')
+
+    def add_prescreen_arguments(subparser):
+        subparser.add_argument('--max-duration', type=float, metavar='SECONDS',
+                               help='Skip longer videos. Defaults to 30 minutes, 0 for no limit.')
+        subparser.add_argument('--min-duration', type=float, metavar='SECONDS', help='Skip shorter videos.')
+        subparser.add_argument('--allow-live', action='store_true', help='Keep live and upcoming streams.')
+        subparser.add_argument('--definition', choices=('hd', 'sd'), help='Keep only this video definition.')
+
+    def add_download_arguments(subparser):
+        subparser.add_argument('--max-downloads', type=int, default=4, help='Concurrent downloads.')
+        subparser.add_argument('--max-ffmpeg-jobs', type=int, default=2, help='Concurrent ffmpeg conversions.')
+        subparser.add_argument('--retries', type=int, default=3, help='Retries of a failed download.')
+        subparser.add_argument('--no-trim', dest='trim', action='store_false', help='Keep the untrimmed wav.')
+        subparser.add_argument('--trim-format', default='flac', choices=('flac', 'wav'))
+        subparser.add_argument('--trim-workers', type=int, default=2, help='Processes that trim the silence.')
+        subparser.add_argument('--pipeline-depth', type=int,
+                               help='How many videos can be downloading/uploading at a time, which bounds the disk '
+                                    'space of the run. Defaults to 2 * max downloads.')
+        subparser.add_argument('--upload', action='store_true',
+                               help='Upload to SharePoint and delete locally (SHAREPOINT_USER, SHAREPOINT_PASSWORD, '
+                                    'SHAREPOINT_TENANT and SHAREPOINT_CLIENT_ID).')
+        subparser.add_argument('--report-format', nargs='+', default=['json'], choices=('json', 'prometheus', 'csv'),
+                               help='The formats of the run report.')
+        subparser.add_argument('--stream', action='store_true',
+                               help='Pipe the audio stream into ffmpeg instead of downloading it first.')
+        subparser.add_argument('--sample-rate', type=int, help='Resample the audio, e.g. 16000.')
+        subparser.add_argument('--channels', type=int, help='The number of channels, e.g. 1 for mono.')
+        subparser.add_argument('--audio-format', default='wav', choices=('wav', 'flac'),
+                               help='The format ffmpeg writes (before trimming, which writes --trim-format).')
+
+    search_parser = subparsers.add_parser('search', help='Find the videos of a search without downloading them.')
+    add_search_arguments(search_parser)
+    add_prescreen_arguments(search_parser)
+    search_parser.set_defaults(func=search_command)
+
+    download_parser = subparsers.add_parser('download', help='Search and download the videos.')
+    add_search_arguments(download_parser)
+    add_prescreen_arguments(download_parser)
+    add_download_arguments(download_parser)
+    download_parser.add_argument('--with-video', action='store_true', help='Download the video too.')
+    download_parser.add_argument('--audio-from-video', action='store_true',
+                                 help='With --with-video, extract the audio from the video instead of downloading it.')
+    download_parser.set_defaults(func=download_command)
+
+    batch_parser = subparsers.add_parser('batch', help='Run a json manifest of searches.')
+    batch_parser.add_argument('manifest', type=Path)
+    add_prescreen_arguments(batch_parser)
+    add_download_arguments(batch_parser)
+    batch_parser.set_defaults(func=batch_command)
+
+    analyze_parser = subparsers.add_parser('analyze', help='Classify the files of a search as band or single instrument.')
+    add_search_arguments(analyze_parser, keywords=False)
+    analyze_parser.add_argument('reference_path', type=Path,
+                                help='A folder of single instrument samples to fit the thresholds on.')
+    analyze_parser.set_defaults(func=analyze_command)
+
+    analyze_corpus_parser = subparsers.add_parser(
+        'analyze-corpus', help='Build or refresh the similarity index of all the downloads (used by similar).')
+    analyze_corpus_parser.add_argument('--database-root', type=Path, default=DEFAULT_DATABASE_ROOT,
+                                       help='The folder of the searches, all their audio files are indexed.')
+    analyze_corpus_parser.add_argument('--workers', type=int, default=4, help='Processes that extract the features.')
+    analyze_corpus_parser.set_defaults(func=analyze_corpus_command)
+
+    similar_parser = subparsers.add_parser('similar', help='Find the downloads that sound like reference files.')
+    similar_parser.add_argument('reference_files', type=Path, nargs='+', help='E.g. a few bass only samples.')
+    similar_parser.add_argument('--database-root', type=Path, default=DEFAULT_DATABASE_ROOT,
+                                help='The folder of the searches, all their audio files are indexed.')
+    similar_parser.add_argument('-k', type=int, default=50, help='How many files to list.')
+    similar_parser.add_argument('--workers', type=int, default=4, help='Processes that extract the features.')
+    similar_parser.set_defaults(func=similar_command)
+
+    upload_parser = subparsers.add_parser('upload', help='Upload the downloads whose upload didn\'t finish.')
+    add_search_arguments(upload_parser, keywords=False)
+    upload_parser.set_defaults(func=upload_command)
+
+    ledger_parser = subparsers.add_parser('ledger', help='Query the ledger of a search.')
+    add_search_arguments(ledger_parser, keywords=False)
+    ledger_query = ledger_parser.add_mutually_exclusive_group()
+    ledger_query.add_argument('--contains', metavar='URL', help='Was the url downloaded (exit code 0) or not (1).')
+    ledger_query.add_argument('--pending', action='store_true', help='List the downloads that weren\'t uploaded.')
+    ledger_query.add_argument('--list', action='store_true', help='List all the downloads.')
+    ledger_parser.set_defaults(func=ledger_command)
+
+    index_parser = subparsers.add_parser('index', help='Query the videos that the searches found.')
+    index_parser.add_argument('--database-root', type=Path, default=DEFAULT_DATABASE_ROOT,
+                              help='The folder of the searches (where video_index.sqlite is).')
+    index_search = index_parser.add_mutually_exclusive_group()
+    index_search.add_argument('--search', metavar='SEARCH_TERM', help='Only the videos this search found.')
+    index_search.add_argument('--database-path', type=Path,
+                              help='Only the videos found by the search saved in this folder '
+                                   '(a search that was run with --database-path).')
+    index_parser.add_argument('--since', metavar='DATE', help='Only the videos first seen since, e.g. 2024-05-01.')
+    index_parser.add_argument('--text', help='Only the videos with this text in the title or description.')
+    index_parser.add_argument('--channel', help='Only the videos of channels with this in their title.')
+    index_parser.add_argument('--limit', type=int, help='At most this many videos.')
+    index_parser.add_argument('--count', action='store_true', help='Print only how many videos match.')
+    index_parser.set_defaults(func=index_command)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
+
+
+#@TODO:
+    # 1) Delete files that contain band.
+    # 2) Trim people talking and remain only bass parts.
 
 # def test():
 #     res = {
@@ -466,76 +3539,9 @@ search_term = 'female rap'
 must_have_in_title_or_description = ['female', 'lady', 'she', 'woman', 'girl', '']
 must_not_have_in_title_or_description = ['']
 with_video = False
+"""
 
 
-
-
-
-
-# # Define a function to find the best threshold values
-# def find_best_thresholds(instrument_files):
-#     # Initialize variables to store the best thresholds
-#     best_low_threshold = 0
-#     best_mid_threshold = 0
-#     best_high_threshold = 0
-#     best_mse = float('inf')
-#
-#     # Iterate through a range of possible threshold values
-#     for low_threshold in range(0, 200):
-#         for mid_threshold in range(0, 200):
-#             for high_threshold in range(0, 200):
-#                 # Initialize a variable to store the mean squared error
-#                 mse = 0
-#
-#                 # Perform spectral analysis on each instrument file
-#                 for file in instrument_files:
-#                     instrument_spectrum = spectral_analysis(file)
-#                     low_error = (instrument_spectrum[0] - low_threshold) ** 2
-#                     mid_error = (instrument_spectrum[1] - mid_threshold) ** 2
-#                     high_error = (instrument_spectrum[2] - high_threshold) ** 2
-#                     mse += low_error + mid_error + high_error
-#
-#                 # Average the mean squared error
-#                 mse /= len(instrument_files)
-#
-#                 # Check if this set of thresholds has a lower mean squared error
-#                 if mse < best_mse:
-#                     best_low_threshold = low_threshold
-#                     best_mid_threshold = mid_threshold
-#                     best_high_threshold = high_threshold
-#                     best_mse = mse
-#
-#     return best_low_threshold, best_mid_threshold, best_high_threshold
-#
-# def process_audio(database_path):
-#     """
-#     1) Trim leading and trailing silence from an audio signal.
-#     2) Delete files that contain band.
-#     3) Trim people talking and remain only bass parts.
-#     """
-#     best_thresholds_2 = find_best_thresholds_2(Path(r'/Volumes/p4client/RND/MainDev/RND/Idanko/AudioScrape/bass_only')) # ran 1 time and get the best thresholds for 3 samples of single acoustic bass.
-#     best_low_threshold, best_mid_threshold, best_high_threshold = best_thresholds_2[0], best_thresholds_2[1], best_thresholds_2[2]
-#     # best_low_threshold, best_mid_threshold, best_high_threshold = 1680.3934075789475, 3132.2453727500047, 3335.117955657623
-#     database_path = Path('/Volumes/p4client/RND/MainDev/RND/Idanko/AudioScrape/Fretless Bass Search cropped_30_seconds')
-#     band_samples, single_instrument, failed_files = [], [], []
-#     for file in os.listdir(database_path):
-#         file = Path(database_path.joinpath(file))
-#         try:
-#             file_spectrum = spectral_analysis(file)
-#         except Exception as e:
-#             failed_files.append(file)
-#             continue
-#         if file_spectrum[0] > best_low_threshold and file_spectrum[1] > best_mid_threshold and file_spectrum[2] > best_high_threshold:
-#             print("This is may be full band sample")
-#             band_samples.append(file)
-#         else:
-#             print('This is an instrument sample')
-#             single_instrument.append(file)
-#
-#     print(band_samples)
-#     print(single_instrument)
-#     print(failed_files)
-
 # def scan_already_downloaded_files(database_path):
 #     youtube_video_names = os.listdir(database_path)
 #     if len(youtube_video_names) > 0:
@@ -0,0 +1,223 @@
+"""
+Tests of SharePointUploader against a local mock of the SharePoint REST endpoints it uses.
+
+python -m pytest test_sharepoint.py
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+import threading
+import json
+import re
+
+import pytest
+
+import main
+
+TOKEN = 'test-token'
+SITE_PATH = '/teams/Audio Data'
+FOLDER = 'Shared Documents/bass Search'
+
+
+class MockSharePoint(ThreadingHTTPServer):
+    """
+    The REST endpoints of one SharePoint site, kept in memory: folders, files and chunked upload sessions.
+    fail_uploads is a set of (operation, file offset) that fail once with a 503, e.g. {('continueUpload', 20)}.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MockSharePointHandler)
+        self.lock = threading.Lock()
+        self.folders = {SITE_PATH}
+        self.files = dict()
+        self.sessions = dict()
+        self.fail_uploads = set()
+        self.requests = []
+
+    @property
+    def site_url(self):
+        return f'http://127.0.0.1:{self.server_port}{SITE_PATH}'
+
+    def operations(self, name):
+        return [request for request in self.requests if name.lower() in request.lower()]
+
+
+class MockSharePointHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;odata=verbose')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def error(self, status, message):
+        self.reply(status, {'error': {'code': str(status), 'message': {'lang': 'en-US', 'value': message}}})
+
+    def file_entity(self, path):
+        return {'d': {'__metadata': {'type': 'SP.File'}, 'Name': path.rsplit('/', 1)[-1],
+                      'ServerRelativeUrl': path, 'Length': str(len(self.server.files[path]))}}
+
+    def do_GET(self):
+        self.handle_request(b'')
+
+    def do_POST(self):
+        self.handle_request(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+    def handle_request(self, body):
+        server = self.server
+        path = unquote(self.path)
+        with server.lock:
+            server.requests.append(f'{self.command} {path}')
+            if self.headers.get('Authorization') != f'Bearer {TOKEN}':
+                return self.error(401, 'Unauthorized')
+            if path.endswith('/_api/contextInfo'):
+                return self.reply(200, {'d': {'GetContextWebInformation': {
+                    'FormDigestValue': 'digest', 'FormDigestTimeoutSeconds': 1800}}})
+            if self.command != 'GET' and self.headers.get('X-RequestDigest') != 'digest':
+                return self.error(403, 'The security validation for this page is invalid')
+            return self.route(path, body)
+
+    def route(self, path, body):
+        server = self.server
+        match = re.search(r"/_api/Web/getFolderByServerRelativeUrl\('([^']*)'\)$", path)
+        if match:
+            if match[1] not in server.folders:
+                return self.error(404, 'File Not Found.')
+            return self.reply(200, {'d': {'__metadata': {'type': 'SP.Folder'}, 'ServerRelativeUrl': match[1]}})
+        match = re.search(r"/_api/Web/folders/add\('([^']*)'\)$", path, re.IGNORECASE)
+        if match:
+            server.folders.add(match[1])
+            return self.reply(200, {'d': {'__metadata': {'type': 'SP.Folder'}, 'ServerRelativeUrl': match[1]}})
+        match = re.search(r"getFolderByServerRelativeUrl\('([^']*)'\)/Files/add\(overwrite=true,url='([^']*)'\)$",
+                          path)
+        if match:
+            if match[1] not in server.folders:
+                return self.error(404, 'File Not Found.')
+            file_path = f'{match[1]}/{match[2]}'
+            server.files[file_path] = body
+            return self.reply(200, self.file_entity(file_path))
+        match = re.search(r"getFileByServerRelativeUrl\('([^']*)'\)/(startUpload|continueUpload|finishUpload)"
+                          r"\(uploadID='([^']*)'(?:,fileOffset=(\d+))?\)$", path)
+        if match:
+            return self.upload_chunk(match[1], match[2], match[3], int(match[4] or 0), body)
+        return self.error(400, f'Unexpected request {path}')
+
+    def upload_chunk(self, file_path, operation, upload_id, offset, body):
+        server = self.server
+        if file_path not in server.files:
+            return self.error(404, 'File Not Found.')
+        if (operation, offset) in server.fail_uploads:
+            server.fail_uploads.discard((operation, offset))
+            return self.error(503, 'Service Unavailable')
+        if operation == 'startUpload':
+            server.sessions[upload_id] = body
+        elif upload_id not in server.sessions or len(server.sessions[upload_id]) != offset:
+            return self.error(400, f'Unknown upload session or wrong offset {offset}')
+        else:
+            server.sessions[upload_id] += body
+        if operation == 'finishUpload':
+            server.files[file_path] = server.sessions.pop(upload_id)
+            return self.reply(200, self.file_entity(file_path))
+        return self.reply(200, {'d': {operation[0].upper() + operation[1:]: str(len(server.sessions[upload_id]))}})
+
+
+@pytest.fixture
+def sharepoint():
+    server = MockSharePoint()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def uploader(sharepoint, state_path=None, token=TOKEN, chunk_size=10):
+    def token_func():
+        return {'access_token': token, 'token_type': 'Bearer'}
+    return main.SharePointUploader(sharepoint.site_url, token_func=token_func, chunk_size=chunk_size,
+                                   state_path=state_path)
+
+
+def test_upload_creates_the_folder_once(sharepoint, tmp_path):
+    files = [tmp_path.joinpath(f'{name}.wav') for name in ('a', 'b')]
+    for file_path in files:
+        file_path.write_bytes(file_path.name.encode())
+    errors = uploader(sharepoint).upload_many(files, FOLDER)
+    assert errors == dict()
+    assert sharepoint.files == {f'{SITE_PATH}/{FOLDER}/a.wav': b'a.wav', f'{SITE_PATH}/{FOLDER}/b.wav': b'b.wav'}
+    assert len(sharepoint.operations('/folders/add(')) == 1
+    assert not sharepoint.operations('Upload(')
+
+
+def test_chunked_upload(sharepoint, tmp_path):
+    file_path = tmp_path.joinpath('big.wav')
+    file_path.write_bytes(bytes(range(35)))
+    state_path = tmp_path.joinpath('upload_sessions.json')
+    uploader(sharepoint, state_path).upload(file_path, FOLDER)
+    assert sharepoint.files[f'{SITE_PATH}/{FOLDER}/big.wav'] == bytes(range(35))
+    assert [len(sharepoint.operations(name)) for name in ('startUpload', 'continueUpload', 'finishUpload')] == [1, 2, 1]
+    # The finished upload is removed from the state.
+    assert json.loads(state_path.read_text()) == dict()
+
+
+def test_chunked_upload_resumes_from_state(sharepoint, tmp_path):
+    file_path = tmp_path.joinpath('big.wav')
+    file_path.write_bytes(bytes(range(35)))
+    state_path = tmp_path.joinpath('upload_sessions.json')
+    sharepoint.fail_uploads.add(('continueUpload', 20))
+    with pytest.raises(Exception):
+        uploader(sharepoint, state_path).upload(file_path, FOLDER)
+    session, = json.loads(state_path.read_text()).values()
+    assert session['offset'] == 20
+
+    # A new run (a new uploader) continues from the saved offset instead of starting over.
+    sharepoint.requests.clear()
+    uploader(sharepoint, state_path).upload(file_path, FOLDER)
+    assert sharepoint.files[f'{SITE_PATH}/{FOLDER}/big.wav'] == bytes(range(35))
+    assert not sharepoint.operations('startUpload')
+    assert not sharepoint.operations('/Files/add(')
+    assert json.loads(state_path.read_text()) == dict()
+
+
+def test_expired_session_starts_over(sharepoint, tmp_path):
+    file_path = tmp_path.joinpath('big.wav')
+    file_path.write_bytes(bytes(range(35)))
+    state_path = tmp_path.joinpath('upload_sessions.json')
+    sharepoint.fail_uploads.add(('continueUpload', 20))
+    with pytest.raises(Exception):
+        uploader(sharepoint, state_path).upload(file_path, FOLDER)
+    sharepoint.sessions.clear()
+    uploader(sharepoint, state_path).upload(file_path, FOLDER)
+    assert sharepoint.files[f'{SITE_PATH}/{FOLDER}/big.wav'] == bytes(range(35))
+    assert len(sharepoint.operations('startUpload')) == 2
+
+
+def test_bad_credentials_are_not_hidden(sharepoint, tmp_path):
+    file_path = tmp_path.joinpath('a.wav')
+    file_path.write_bytes(b'a')
+    with pytest.raises(Exception, match='401'):
+        uploader(sharepoint, token='wrong').upload(file_path, FOLDER)
+    assert not sharepoint.operations('/folders/add(')
+    assert sharepoint.files == dict()
+
+
+def test_password_sign_in_errors_are_raised(monkeypatch):
+    class FailingApp:
+        def __init__(self, client_id, authority):
+            pass
+
+        def get_accounts(self, username=None):
+            return []
+
+        def acquire_token_by_username_password(self, username, password, scopes):
+            return {'error': 'invalid_grant', 'error_description': 'AADSTS50126: Invalid username or password.'}
+
+    monkeypatch.setattr('msal.PublicClientApplication', FailingApp)
+    token = main.sharepoint_password_token('https://example.sharepoint.com/teams/Audio', 'tenant', 'client',
+                                           'user@example.com', 'wrong')
+    with pytest.raises(PermissionError, match='AADSTS50126'):
+        token()